@@ -2,7 +2,7 @@ import h5py
 import numpy as np
 import os
 import pickle as pkl
-from nmr.analysis.util import count_num_heavy
+from nmr.analysis.util import count_num_heavy_batch
 
 def collate_predictions(pred_sets: list[h5py.File],
                         pad_tkn: int = None) -> tuple[np.ndarray, np.ndarray]:
@@ -10,6 +10,9 @@ def collate_predictions(pred_sets: list[h5py.File],
     
     In the case that the predictions are not all the same length in the final dimension,
     padding is performed using the given pad_tkn.
+
+    The outputs are allocated once and each dataset is read directly into its slice
+    of the output, avoiding intermediate copies of the data.
     """
     all_targets = []
     all_predictions = []
@@ -20,49 +23,71 @@ def collate_predictions(pred_sets: list[h5py.File],
         assert('smiles' in pset.keys())
         all_targets.append(pset['targets'])
         all_predictions.append(pset['predictions'])
-        all_smiles.append(pset['smiles'])
+        all_smiles.append(pset['smiles'][()])
     #Check prediction length in the last dimension
     pred_lens = [p.shape[-1] for p in all_predictions]
+    max_len = max(pred_lens)
+    pred_dtype = np.result_type(*[p.dtype for p in all_predictions])
+    total = sum(p.shape[0] for p in all_predictions)
+    pred_shape = (total, *all_predictions[0].shape[1:-1], max_len)
     if len(set(pred_lens)) > 1:
         print("Uneven lengths detected, correcting!")
-        max_len = max(pred_lens)
-        for i in range(len(all_predictions)):
-            curr_len = all_predictions[i].shape[-1]
-            if curr_len < max_len:
-                pad_amt = max_len - curr_len
-                pad_shape = list(all_predictions[i].shape)
-                pad_shape[-1] = pad_amt
-                pad_arr = np.full(pad_shape, pad_tkn)
-                all_predictions[i] = np.concatenate([all_predictions[i], pad_arr], axis = -1)
-    return np.concatenate(all_targets), np.concatenate(all_predictions), np.concatenate(all_smiles)
+        pred_dtype = np.result_type(pred_dtype, np.asarray(pad_tkn).dtype)
+        collated_predictions = np.full(pred_shape, pad_tkn, dtype = pred_dtype)
+    else:
+        collated_predictions = np.empty(pred_shape, dtype = pred_dtype)
+    targ_dtype = np.result_type(*[t.dtype for t in all_targets])
+    collated_targets = np.empty((total, *all_targets[0].shape[1:]), dtype = targ_dtype)
+
+    offset = 0
+    for targ, pred in zip(all_targets, all_predictions):
+        n, curr_len = pred.shape[0], pred.shape[-1]
+        if n > 0:
+            targ.read_direct(collated_targets, dest_sel = np.s_[offset:offset + n])
+            pred.read_direct(collated_predictions, dest_sel = np.s_[offset:offset + n, ..., :curr_len])
+        offset += n
+    return collated_targets, collated_predictions, np.concatenate(all_smiles)
 
 def format_SMILES_preds_into_h5(f: h5py.File, 
                          good_targets: list[str],
                          preds_with_losses: list[list[tuple[str, float]]],
                          bad_targets: list[str],
                          bad_predictions: list[list[str]],
-                         bad_scores: list[list[float]]) -> None:
+                         bad_scores: list[list[float]],
+                         num_heavy_atoms: np.ndarray = None) -> None:
+    '''num_heavy_atoms is the precomputed array of heavy atom counts for the good targets, 
+    computed here if not given'''
     #Save the bad predictions as a concatenated 2D array to save space
     bad_grp = f.create_group('bad_predictions')
     bad_grp.create_dataset('targets', data = bad_targets)
     bad_grp.create_dataset('predictions', data = np.array(bad_predictions))
     bad_grp.create_dataset('scores', data=np.array(bad_scores))
-    #Generate a separate entry for each good prediction
+    #Save the good predictions as flat datasets, ragged rows are padded with empty strings 
+    #   and NaNs up to the largest number of valid predictions. The number of valid 
+    #   predictions for each target is stored in num_predictions
     good_grp = f.create_group('valid_predictions')
-    for i in range(len(good_targets)):
-        curr_targ = good_targets[i]
-        curr_pred = preds_with_losses[i]
-        pred_strings = [x[0] for x in curr_pred]
-        pred_losses = [x[1] for x in curr_pred]
-        pred_scores = [x[2] for x in curr_pred]
-
-        #Saving predictions separately gets around the issue of ragged 2D arrays
-        pred_grp = good_grp.create_group(f'{i}')
-        pred_grp.create_dataset('target', data = curr_targ)
-        pred_grp.create_dataset('prediction_strings', data = pred_strings)
-        pred_grp.create_dataset('prediction_bce_losses', data = pred_losses)
-        pred_grp.create_dataset('num_heavy_atoms', data = count_num_heavy(curr_targ))
-        pred_grp.create_dataset('prediction_scores', data=pred_scores)
+    n_targets = len(good_targets)
+    max_preds = max((len(p) for p in preds_with_losses), default = 0)
+    pred_strings = np.full((n_targets, max_preds), '', dtype = object)
+    pred_losses = np.full((n_targets, max_preds), np.nan)
+    pred_scores = np.full((n_targets, max_preds), np.nan)
+    num_predictions = np.zeros(n_targets, dtype = np.int32)
+    if num_heavy_atoms is None:
+        num_heavy_atoms = count_num_heavy_batch(good_targets)
+    #Single pass over the targets, each row of (string, loss, score) tuples is transposed once
+    for i, curr_pred in enumerate(preds_with_losses):
+        n = len(curr_pred)
+        num_predictions[i] = n
+        if n > 0:
+            pred_strings[i, :n], pred_losses[i, :n], pred_scores[i, :n] = zip(*curr_pred)
+    #Empty datasets cannot be chunked
+    storage_opts = {'chunks' : True, 'compression' : 'gzip', 'compression_opts' : 4} if n_targets > 0 else {}
+    good_grp.create_dataset('targets', data = np.array(good_targets, dtype = h5py.string_dtype()), **storage_opts)
+    good_grp.create_dataset('prediction_strings', data = pred_strings.astype(h5py.string_dtype()), **storage_opts)
+    good_grp.create_dataset('prediction_bce_losses', data = pred_losses, **storage_opts)
+    good_grp.create_dataset('prediction_scores', data = pred_scores, **storage_opts)
+    good_grp.create_dataset('num_predictions', data = num_predictions, **storage_opts)
+    good_grp.create_dataset('num_heavy_atoms', data = num_heavy_atoms, **storage_opts)
 
 def postprocess_save_SMILES_results(f: h5py.File,
                                     savename: str,
@@ -84,7 +109,7 @@ def postprocess_save_SMILES_results(f: h5py.File,
             - bad_targets: The SMILES strings that were unsuccessfully predicted and could not be processed
             - bad_predictions: The SMILES strings that were unsuccessfully predicted and could not be processed
         For optimization, the failures are saved together in one entry as a 2D matrix and the good predictions 
-        are saved one entry at a time due potential ragged arrays.
+        are saved as flat datasets padded to the largest number of valid predictions per target.
     """
     group = f.create_group(savename)
     good_targets = []
@@ -99,12 +124,15 @@ def postprocess_save_SMILES_results(f: h5py.File,
         bad_targets.extend(result[2])
         bad_predictions.extend(result[3])
         bad_scores.extend(result[4])
+    #Heavy atom counts are computed in one pass before writing
+    num_heavy_atoms = count_num_heavy_batch(good_targets)
     format_SMILES_preds_into_h5(group, 
                                 good_targets, 
                                 preds_with_losses, 
                                 bad_targets, 
                                 bad_predictions,
-                                bad_scores)
+                                bad_scores,
+                                num_heavy_atoms)
 
 def postprocess_save_substructure_results(savedir: str,
                                           metrics_dict: dict) -> None:
@@ -9,11 +9,11 @@ from typing import Callable
 def count_num_heavy(smi: str) -> int:
     """Counts the number of heavy (non-hydrogen) atoms in a SMILES string"""
     mol = chem.MolFromSmiles(smi)
-    total = 0
-    for atom in mol.GetAtoms():
-        if atom.GetAtomicNum() > 1:
-            total += 1
-    return total
+    return mol.GetNumHeavyAtoms()
+
+def count_num_heavy_batch(smiles: list[str]) -> np.ndarray:
+    """Counts the number of heavy atoms for each SMILES string, returned as an int32 array"""
+    return np.fromiter((count_num_heavy(smi) for smi in smiles), dtype = np.int32, count = len(smiles))
 
 def construct_substructure_mols(substructures: list[str]) -> list[chem.Mol]:
     """
@@ -132,8 +132,8 @@ class NMRDataset(Dataset):
             #Note: model_input is a Tensor, model_target is a tuple of Tensors!
             model_input = self.input_generator.transform(spectra_data, smiles_data, label_data)
             model_target = self.target_generator.transform(spectra_data, smiles_data, label_data)
-            model_input = torch.from_numpy(model_input).to(self.dtype).to(self.device)
-            model_target = tuple([torch.from_numpy(elem).to(self.dtype).to(self.device) for elem in model_target])
+            model_input = torch.from_numpy(model_input).to(device = self.device, dtype = self.dtype)
+            model_target = tuple([torch.from_numpy(elem).to(device = self.device, dtype = self.dtype) for elem in model_target])
             return (model_input, smiles_data), model_target
     
     def get_sizes(self) -> dict[int, int]:
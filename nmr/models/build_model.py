@@ -5,6 +5,17 @@ from typing import Any
 import warnings
 # warnings.simplefilter('always', UserWarning)
 
+def convert_legacy_state_dict(model: nn.Module, state_dict: dict) -> dict:
+    """Returns a copy of the checkpoint state dictionary with the keys of older checkpoints converted by the 
+    _convert_legacy_state_dict() load hooks of the model's submodules. This has to be applied before the keys 
+    are matched against the model state dictionary for partial loading, otherwise legacy keys are dropped
+    """
+    state_dict = dict(state_dict)
+    for name, module in model.named_modules():
+        if hasattr(module, '_convert_legacy_state_dict'):
+            module._convert_legacy_state_dict(state_dict, f'{name}.' if name else '')
+    return state_dict
+
 def create_model(model_args: dict, dtype: torch.dtype, device: torch.device) -> nn.Module:
     """Creates the model by passing argument dictoinaries into fetched constructors
     Args:
@@ -18,7 +29,8 @@ def create_model(model_args: dict, dtype: torch.dtype, device: torch.device) ->
                        device=device,
                        **model_config)
     if model_args['load_model'] is not None:
-        ckpt = torch.load(model_args['load_model'], map_location=device)['model_state_dict']
+        ckpt = torch.load(model_args['load_model'], map_location=device, mmap=True)['model_state_dict']
+        ckpt = convert_legacy_state_dict(model, ckpt)
         try:
             model.load_state_dict(ckpt)
             print("Model loaded successfully")
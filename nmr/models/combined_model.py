@@ -44,10 +44,10 @@ class CombinedModel(nn.Module):
         #Initialize the weights for each sub checkpoint if not loading the 
         #   overall model state dictionary
         if model_1_ckpt is not None:
-            ckpt = torch.load(model_1_ckpt, map_location=device)
+            ckpt = torch.load(model_1_ckpt, map_location=device, mmap=True)
             self.model_1.load_state_dict(ckpt['model_state_dict'])
         if model_2_ckpt is not None:
-            ckpt = torch.load(model_2_ckpt, map_location=device)
+            ckpt = torch.load(model_2_ckpt, map_location=device, mmap=True)
             self.model_2.load_state_dict(ckpt['model_state_dict'])
     
     def initialize_weights(self) -> None:
@@ -35,7 +35,7 @@ class LightningModel(L.LightningModule):
 
     def load_model_from_checkpoint(self, filename):
         print(f"Loading model from ckpt file {filename}")
-        ckpt = torch.load(filename)['state_dict']
+        ckpt = torch.load(filename, mmap=True)['state_dict']
         #Remove the 'model.' prefix from state dict keys
         ckpt = {".".join(k.split(".")[1:]): v for k, v in ckpt.items()}
         try:
@@ -64,6 +64,7 @@ class LightningModel(L.LightningModule):
         optimizer_base = getattr(optim, self.training_args['optimizer'])
         optimizer = optimizer_base(self.model.parameters(), **self.training_args['optimizer_args'])
         if self.model_args['load_model'] is not None and self.model_args['load_optimizer']:
+            #Not memory-mapped since the optimizer keeps the loaded state tensors
             ckpt = torch.load(self.model_args['load_model'])['optimizer_state_dict']
             optimizer.load_state_dict(ckpt)
         return optimizer
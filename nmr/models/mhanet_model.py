@@ -23,7 +23,9 @@ class MHANetModel(nn.Module):
                  max_src_len: int,
                  freeze_components: Optional[list[str]] = None,
                  device: torch.device = None,
-                 dtype: torch.dtype = None):
+                 dtype: torch.dtype = None,
+                 precision: str = 'fp32',
+                 compile_forward: bool = False):
         """Implements a minimal multihead attention model
 
         Args:
@@ -45,6 +47,8 @@ class MHANetModel(nn.Module):
             freeze_components: List of component names to freeze weights of
             device: The device to use for the model
             dtype: The datatype to use for the model
+            precision: The precision for the forward pass, one of 'bf16', 'fp16', or 'fp32'
+            compile_forward: Whether to compile the network forward pass with torch.compile
         """
         super().__init__()
         
@@ -88,12 +92,15 @@ class MHANetModel(nn.Module):
             n_heads,
             max_src_len,
             device,
-            dtype
+            dtype,
+            precision,
+            compile_forward
         )
 
         self.initialize_weights()
         self.device = device
         self.dtype = dtype
+        self.precision = precision
         self.freeze_components = freeze_components
 
     def initialize_weights(self) -> None:
@@ -127,3 +134,17 @@ class MHANetModel(nn.Module):
                  loss_fn: Callable[[Tensor, Tensor], Tensor]) -> Tensor:
         return self.network.get_loss(x, y, loss_fn) 
 
+    def quantize(self, dtype: str = 'qint8') -> nn.Module:
+        """Returns a copy of the model with its nn.Linear layers dynamically quantized for CPU inference
+        Args:
+            dtype: The quantized weight dtype, either 'qint8' or 'float16'
+        """
+        return torch.ao.quantization.quantize_dynamic(self, {nn.Linear}, dtype = getattr(torch, dtype))
+
+    def to_script(self, example_src: Tensor) -> torch.jit.ScriptModule:
+        """Returns a frozen TorchScript module for inference that is called as module(src)
+        Args:
+            example_src: An example batch of the src tensor used to trace the model
+        """
+        return forward_fxns.export_torchscript(self, (example_src,))
+
@@ -3,6 +3,7 @@ import torch
 from torch import nn, Tensor
 from typing import Tuple, Callable, Optional, Any
 import nmr.models
+from nmr.models.build_model import convert_legacy_state_dict
 import warnings
 
 class MultiTaskModel(nn.Module):
@@ -57,7 +58,8 @@ class MultiTaskModel(nn.Module):
         self.substructure_model.freeze()
 
     def _partial_load_weights(self, model: nn.Module, ckpt: str) -> None:
-        ckpt = torch.load(ckpt, map_location = self.device)['model_state_dict']
+        ckpt = torch.load(ckpt, map_location = self.device, mmap = True)['model_state_dict']
+        ckpt = convert_legacy_state_dict(model, ckpt)
         model_state = model.state_dict()
         pretrained_dictionary = {}
         for k, v in ckpt.items():
@@ -31,7 +31,8 @@ class TransformerModel(nn.Module):
                  batch_first: bool = True, 
                  norm_first: bool = False, 
                  device: torch.device = None, 
-                 dtype: torch.dtype = torch.float):
+                 dtype: torch.dtype = torch.float,
+                 precision: str = 'fp32'):
         r"""Most parameters are standard for the PyTorch transformer class. A few specific ones that have been added:
 
         src_embed: The name of the embedding module for the src tensor passed to the model
@@ -49,6 +50,7 @@ class TransformerModel(nn.Module):
         source_size (int): Size of the source alphabet (including start, stop, and pad tokens).
         batch_first is set to be default True, more intuitive to reason about dimensionality if batching 
             dimension is first
+        precision: The precision for the forward pass, one of 'bf16', 'fp16', or 'fp32'
         """
 
         super().__init__()
@@ -82,11 +84,13 @@ class TransformerModel(nn.Module):
                                                 d_model, nhead, num_encoder_layers, num_decoder_layers,
                                                 dim_feedforward, dropout, activation, custom_encoder,
                                                 custom_decoder, target_size, source_size,
-                                                layer_norm_eps, batch_first, norm_first, device, dtype)
+                                                layer_norm_eps, batch_first, norm_first, device, dtype,
+                                                precision)
         self.initialize_weights()
         self.freeze_components = freeze_components
         self.device = device
         self.dtype = dtype
+        self.precision = precision
 
     def initialize_weights(self) -> None:
         """Initializes network weights
@@ -120,6 +124,22 @@ class TransformerModel(nn.Module):
                  y: Tuple[Tensor], 
                  loss_fn: Callable[[Tensor, Tensor], Tensor]) -> Tensor:
         return self.network.get_loss(x, y, loss_fn)
+
+    def quantize(self, dtype: str = 'qint8') -> nn.Module:
+        """Returns a copy of the model with its nn.Linear layers dynamically quantized for CPU inference
+        Args:
+            dtype: The quantized weight dtype, either 'qint8' or 'float16'
+        """
+        return torch.ao.quantization.quantize_dynamic(self, {nn.Linear}, dtype = getattr(torch, dtype))
+
+    def to_script(self, example_src: Tensor, example_tgt: Tensor) -> torch.jit.ScriptModule:
+        """Returns a frozen TorchScript module for inference that is called as module(src, shifted_tgt)
+        Args:
+            example_src: An example batch of the src tensor used to trace the model
+            example_tgt: An example batch of the shifted tgt tensor used to trace the model. This should be 
+                padded to the maximum target length since the causal mask is captured at this size
+        """
+        return forward_fxns.export_torchscript(self, (example_src, example_tgt))
     
 
 
@@ -2,6 +2,7 @@ import torch
 import numpy as np
 from torch import nn, Tensor
 from typing import Tuple, Callable
+from nmr.networks.forward_fxns import PRECISION_DTYPES, autocast_context
 
 class H1Embed(nn.Module):
     """
@@ -68,9 +69,9 @@ class MultiHeadOutput(nn.Module):
             nn.Linear(1024, 1) for _ in range(n_substructures)
         ])
     
-    def forward(self, x: Tensor) -> Tensor:
-        outputs = [nn.Sigmoid()(head(x)) for head in self.heads]
-        return torch.cat(outputs, dim = -1)
+    def forward(self, x: Tensor, return_logits: bool = False) -> Tensor:
+        outputs = torch.cat([head(x) for head in self.heads], dim = -1)
+        return outputs if return_logits else torch.sigmoid(outputs)
 
 class NMRConvNet(nn.Module):
 
@@ -83,7 +84,7 @@ class NMRConvNet(nn.Module):
     model_id = 'CNN'
     
     def __init__(self, n_spectral_features: int, n_Cfeatures: int, n_molfeatures: int, n_substructures: int,
-                 dtype: torch.dtype = torch.float, device: torch.device = None):
+                 dtype: torch.dtype = torch.float, device: torch.device = None, precision: str = 'fp32'):
         """
         Args:
             n_spectral_features: The number of spectral features, i.e. 28000
@@ -93,13 +94,17 @@ class NMRConvNet(nn.Module):
                 constructing a single linear head for each substructure
             dtype: Model datatype. Default is torch.float
             device: Model device. Default is None
+            precision: The precision used for the forward pass in get_loss, one of 'bf16', 'fp16', or 'fp32'.
+                Reduced precisions run under torch.autocast while the loss is still computed in full precision
         """
+        assert(precision in PRECISION_DTYPES)
         super().__init__()
         self.n_Cfeatures = n_Cfeatures
         self.n_molfeatures = n_molfeatures
         self.n_spectral_features = n_spectral_features
         self.dtype = dtype
         self.device = device
+        self.precision = precision
 
         self.h1_embed = H1Embed()
         self.relu = nn.ReLU()
@@ -132,10 +137,11 @@ class NMRConvNet(nn.Module):
         mol_x = x[:, :, self.n_spectral_features + self.n_Cfeatures:]
         return spectral_x, cnmr_x, mol_x
 
-    def forward(self, x: tuple[Tensor, tuple[str]]) -> Tensor:
+    def forward(self, x: tuple[Tensor, tuple[str]], return_logits: bool = False) -> Tensor:
         """
         Args:
             x: ((batch_size, 1, seq_len), smiles)
+            return_logits: If True, the output heads return logits instead of probabilities
         """
         spectral_x, cnmr_x, mol_x = self._sanitize_forward_args(x)
 
@@ -157,7 +163,7 @@ class NMRConvNet(nn.Module):
         spectral_x = self.relu(spectral_x)
 
         # TODO: test if this is necessary
-        spectral_x = self.out(spectral_x)
+        spectral_x = self.out(spectral_x, return_logits = return_logits)
 
         return spectral_x
     
@@ -174,5 +180,8 @@ class NMRConvNet(nn.Module):
                 tensor, tensor -> tensor
         """
         y_target, = y
-        pred = self.forward(x)
-        return loss_fn(pred, y_target.to(self.dtype).to(self.device))
+        with autocast_context(self.device, self.precision):
+            pred = self.forward(x, return_logits = getattr(loss_fn, 'takes_logits', False))
+        y_target = y_target.to(device = self.device, dtype = self.dtype, non_blocking = True)
+        #Loss reduction is always done in full precision
+        return loss_fn(pred.to(y_target.dtype), y_target)
@@ -47,21 +47,27 @@ class NMRContinuousEmbedding(nn.Module):
 
     def __init__(self, d_model: int, num_heads: int = 1, input_dim: int = 2):
         '''
-        For implementation simplicity, only use one head for now,
-            extending to multiple heads is trivial.
+        The per-head linear layers are equivalent to a single linear layer whose output 
+            features are the concatenation of the heads, so one projection is used.
         '''
         super().__init__()
-        self.heads = nn.ModuleList([
-            nn.Linear(input_dim, d_model // num_heads) for _ in range(num_heads)
-        ])
+        self.num_heads = num_heads
+        self.proj = nn.Linear(input_dim, (d_model // num_heads) * num_heads)
+        self._register_load_state_dict_pre_hook(self._convert_legacy_state_dict)
+    
+    def _convert_legacy_state_dict(self, state_dict: dict, prefix: str, *args) -> None:
+        '''Concatenates per-head weights (heads.{i}.*) from older checkpoints along out_features'''
+        for param in ['weight', 'bias']:
+            head_keys = [f'{prefix}heads.{i}.{param}' for i in range(self.num_heads)]
+            if all(k in state_dict for k in head_keys):
+                state_dict[f'{prefix}proj.{param}'] = torch.cat([state_dict.pop(k) for k in head_keys], dim = 0)
     
     def forward(self, x):
         '''
         x: Tensor, shape (batch_size, seq_len, 2)
         Returns the embedded tensor (batch_size, seq_len, d_model)
         '''
-        out = [head(x) for head in self.heads]
-        return torch.cat(out, dim = -1)
+        return self.proj(x)
     
 class NNEmbedWithTypeFeature(nn.Module):
     """Embedding layer for spectral source data that includes a type feature
@@ -5,6 +5,7 @@ import pickle, os
 import math
 import torch.nn.functional as f
 from typing import Optional, Any, Callable
+from nmr.networks.forward_fxns import PRECISION_DTYPES, autocast_context
 
 class PositionalEncoding(nn.Module):
 
@@ -16,7 +17,8 @@ class PositionalEncoding(nn.Module):
 
         position = torch.arange(max_len).unsqueeze(1)
         div_term = torch.exp(torch.arange(0, d_model, 2) * (-math.log(10000.0) / d_model))
-        pe = torch.zeros(1, max_len, d_model)
+        #The table is always generated in full precision, it is only cast on .to(dtype) or when added
+        pe = torch.zeros(1, max_len, d_model, dtype = torch.float32)
         pe[0, :, 0::2] = torch.sin(position * div_term)
         pe[0, :, 1::2] = torch.cos(position * div_term)
         self.register_buffer('pe', pe)
@@ -29,10 +31,11 @@ class PositionalEncoding(nn.Module):
         '''
         #Select and expand the PE to be the right shape first
         if ind is not None:
-            added_pe = self.pe[torch.arange(1).reshape(-1, 1), ind, :]
-            x = x + added_pe
+            #Gather rows of the (max_len, d_model) table directly, (N, T) -> (N, T, E)
+            x = x + f.embedding(ind, self.pe[0]).to(x.dtype)
         else:
-            x = x + self.pe[:, :x.size(1), :]
+            #Only the used slice is cast so that reduced precision inputs are not promoted
+            x = x + self.pe[:, :x.size(1), :].to(x.dtype)
         return self.dropout(x)
 
 ### Poolers ###
@@ -83,11 +86,11 @@ class SingleLinear(nn.Module):
     def __init__(self, d_model: int, d_out: int):
         super().__init__()
         self.network = nn.Sequential(
-            nn.Linear(d_model, d_out),
-            nn.Sigmoid()
+            nn.Linear(d_model, d_out)
         )
-    def forward(self, x: Tensor) -> Tensor:
-        return self.network(x)  
+    def forward(self, x: Tensor, return_logits: bool = False) -> Tensor:
+        logits = self.network(x)
+        return logits if return_logits else torch.sigmoid(logits)
     
 class EncoderNetwork(nn.Module):
 
@@ -116,7 +119,8 @@ class EncoderNetwork(nn.Module):
                  num_layers: int = 6,
                  enable_nested_tensor: bool = True,
                  device: torch.device = None,
-                 dtype: torch.dtype = torch.float
+                 dtype: torch.dtype = torch.float,
+                 precision: str = 'fp32'
                  ):
         r"""Most parameters are for the PyTorch TransformerEncoderLayer module.
         Args:
@@ -145,7 +149,10 @@ class EncoderNetwork(nn.Module):
                 improves performance when padding is high
             device: The device for the model
             dtype: The dtype for the model
+            precision: The precision used for the forward pass in get_loss, one of 'bf16', 'fp16', or 'fp32'.
+                Reduced precisions run under torch.autocast while the loss is still computed in full precision
         """
+        assert(precision in PRECISION_DTYPES)
         super().__init__()
         self.src_embed = src_embed
         self.src_size = source_size
@@ -162,6 +169,7 @@ class EncoderNetwork(nn.Module):
 
         self.dtype = dtype
         self.device = device
+        self.precision = precision
 
         #Construct the encoder model. Process taken from 
         #   https://pytorch.org/docs/stable/_modules/torch/nn/modules/transformer.html#Transformer
@@ -195,19 +203,22 @@ class EncoderNetwork(nn.Module):
             x = x.long()
         return x
     
-    def forward(self, x: tuple[Tensor, tuple[str]]) -> Tensor:
+    def forward(self, x: tuple[Tensor, tuple[str]], return_logits: bool = False) -> Tensor:
         src = self._sanitize_forward_args(x)
         src_embedded, src_key_pad_mask = self.src_fwd_fn(src, self.d_model, self.src_embed, self.src_pad_token, self.pos_encoder)
         src_out = self.encoder(src=src_embedded,
                                src_key_padding_mask=src_key_pad_mask)
         src_out = self.pooler(src_out)
-        return self.output_head(src_out)
+        return self.output_head(src_out, return_logits = return_logits)
     
     def get_loss(self, 
                  x: tuple[Tensor, tuple[str]],
                  y: tuple[Tensor],
                  loss_fn: Callable[[Tensor, Tensor], Tensor]) -> Tensor:
-        pred = self.forward(x)
+        with autocast_context(self.device, self.precision):
+            pred = self.forward(x, return_logits = getattr(loss_fn, 'takes_logits', False))
         y_target, = y
-        loss = loss_fn(pred, y_target.to(self.dtype).to(self.device))
+        y_target = y_target.to(device = self.device, dtype = self.dtype, non_blocking = True)
+        #Loss reduction is always done in full precision
+        loss = loss_fn(pred.to(y_target.dtype), y_target)
         return loss
\ No newline at end of file
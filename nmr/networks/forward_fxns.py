@@ -1,8 +1,74 @@
 import torch
 from torch import nn, Tensor
 from typing import Tuple, Optional, Callable
+from contextlib import nullcontext
 import math
 
+### Mixed precision helpers ###
+
+PRECISION_DTYPES = {
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+    'fp32': torch.float32
+}
+
+def autocast_context(device: Optional[torch.device], precision: str) -> torch.autocast | nullcontext:
+    """Returns the autocast context used for the forward pass of a network
+    Args:
+        device: The device of the network. If None, the cpu is assumed
+        precision: One of 'bf16', 'fp16', or 'fp32'. For 'fp32' an empty context is returned rather than 
+            a disabled autocast, so that an autocast region entered by the caller still applies
+    """
+    if precision == 'fp32':
+        return nullcontext()
+    device_type = torch.device(device).type if device is not None else 'cpu'
+    return torch.autocast(device_type = device_type, dtype = PRECISION_DTYPES[precision])
+
+def pad_mask_to_attn_bias(key_pad_mask: Optional[Tensor], dtype: torch.dtype) -> Optional[Tensor]:
+    """Converts a key padding mask into an additive attention bias for F.scaled_dot_product_attention
+    Args:
+        key_pad_mask: Tensor, shape [batch_size, seq_len] where True indicates padding, or NoneType
+        dtype: The dtype of the attention bias, should match the dtype of the queries
+    
+    Returns a tensor of shape [batch_size, 1, 1, seq_len] that broadcasts over heads and query positions,
+    with -inf at padded positions and 0 elsewhere, or None if there is no padding mask
+    """
+    if key_pad_mask is None:
+        return None
+    B, L = key_pad_mask.shape
+    attn_bias = torch.zeros(B, 1, 1, L, dtype = dtype, device = key_pad_mask.device)
+    return attn_bias.masked_fill_(key_pad_mask.view(B, 1, 1, L), float('-inf'))
+
+### TorchScript helpers ###
+
+class TensorInputAdapter(nn.Module):
+    """Wraps a model whose forward takes (tensor, smiles) tuples so that it only takes tensors, 
+    as required by torch.jit.trace. Each positional tensor is passed to the model as (tensor, None)"""
+
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, *inputs: Tensor) -> Tensor:
+        return self.model(*[(inp, None) for inp in inputs])
+
+def export_torchscript(model: nn.Module, example_inputs: tuple[Tensor, ...]) -> torch.jit.ScriptModule:
+    """Traces the model in eval mode on the example inputs and freezes the result for inference. The training 
+    mode of every submodule of the model is restored afterwards
+    Args:
+        model: The model to export, whose forward takes one (tensor, smiles) tuple per input
+        example_inputs: Tuple of example tensors, one per input to the model forward
+    """
+    training_modes = [(m, m.training) for m in model.modules()]
+    try:
+        adapter = TensorInputAdapter(model).eval()
+        with torch.no_grad():
+            traced = torch.jit.trace(adapter, example_inputs)
+    finally:
+        for m, training in training_modes:
+            m.training = training
+    return torch.jit.freeze(traced)
+
 ### Target foward processing functions ###
 
 def tgt_fwd_fxn_basic(tgt: Tensor,
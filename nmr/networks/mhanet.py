@@ -1,9 +1,11 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 import math
 from torch import Tensor
 from typing import Optional, Callable
+from nmr.networks.forward_fxns import PRECISION_DTYPES, autocast_context, pad_mask_to_attn_bias
 
 class PositionalEncoding(nn.Module):
 
@@ -15,7 +17,8 @@ class PositionalEncoding(nn.Module):
 
         position = torch.arange(max_len).unsqueeze(1)
         div_term = torch.exp(torch.arange(0, d_model, 2) * (-math.log(10000.0) / d_model))
-        pe = torch.zeros(1, max_len, d_model)
+        #The table is always generated in full precision, it is only cast on .to(dtype) or when added
+        pe = torch.zeros(1, max_len, d_model, dtype = torch.float32)
         pe[0, :, 0::2] = torch.sin(position * div_term)
         pe[0, :, 1::2] = torch.cos(position * div_term)
         self.register_buffer('pe', pe)
@@ -28,11 +31,19 @@ class PositionalEncoding(nn.Module):
         '''
         #Select and expand the PE to be the right shape first
         if ind is not None:
-            added_pe = self.pe[torch.arange(1).reshape(-1, 1), ind, :]
-            x = x + added_pe
+            #Gather rows of the (max_len, d_model) table directly, (N, T) -> (N, T, E)
+            x = x + F.embedding(ind, self.pe[0]).to(x.dtype)
         else:
-            x = x + self.pe[:, :x.size(1), :]
+            #Only the used slice is cast so that reduced precision inputs are not promoted
+            x = x + self.pe[:, :x.size(1), :].to(x.dtype)
         return self.dropout(x)
+
+class NoPositionalEncoding(nn.Module):
+
+    """ Identity positional encoding that matches the (x, ind) call signature of PositionalEncoding """
+
+    def forward(self, x: Tensor, ind: Optional[Tensor]) -> Tensor:
+        return x
     
 class FlattenNNLinear(nn.Module):
 
@@ -40,7 +51,11 @@ class FlattenNNLinear(nn.Module):
                  d_model: int, 
                  d_out: int, 
                  d_feedforward: int,
-                 max_seq_len: int):
+                 max_seq_len: int,
+                 compile_network: bool = False):
+        '''The network produces logits, the sigmoid is applied in forward() unless logits are requested.
+        If compile_network is True, the network is compiled in place with torch.compile so that 
+        the Linear + ReLU stages are fused'''
         super().__init__()
         d1 = d_feedforward
         d2 = d1 * 2
@@ -52,12 +67,14 @@ class FlattenNNLinear(nn.Module):
             nn.ReLU(),
             nn.Linear(d2, d2),
             nn.ReLU(),
-            nn.Linear(d2, d_out),
-            nn.Sigmoid()
+            nn.Linear(d2, d_out)
         )
+        if compile_network:
+            self.network.compile(mode = 'max-autotune', fullgraph = True)
     
-    def forward(self, x: Tensor) -> Tensor:
-        return self.network(x)
+    def forward(self, x: Tensor, return_logits: bool = False) -> Tensor:
+        logits = self.network(x)
+        return logits if return_logits else torch.sigmoid(logits)
     
 class NNLinearTransposeDownsize(nn.Module):
 
@@ -87,11 +104,10 @@ class NNLinearTransposeDownsize(nn.Module):
             nn.ReLU()
         )
         self.out = nn.Sequential(
-            nn.Linear(layer_dimensions[-1], 1),
-            nn.Sigmoid()
+            nn.Linear(layer_dimensions[-1], 1)
         )
     
-    def forward(self, x: Tensor) -> Tensor:
+    def forward(self, x: Tensor, return_logits: bool = False) -> Tensor:
         '''
         x: Tensor, shape [batch_size, seq_len, d_model]
         '''
@@ -101,8 +117,8 @@ class NNLinearTransposeDownsize(nn.Module):
         x = self.posttranspose(x)
         #(N, D_n, D_out) -> (N, D_out, D_n)
         x = x.transpose(1, 2) 
-        x = self.out(x)
-        return x.squeeze(-1)
+        x = self.out(x).squeeze(-1)
+        return x if return_logits else torch.sigmoid(x)
     
 class MHANet(nn.Module):
 
@@ -121,13 +137,16 @@ class MHANet(nn.Module):
                  n_heads: int, 
                  max_seq_len: int,
                  device: torch.device = None,
-                 dtype: torch.dtype = None):
+                 dtype: torch.dtype = None,
+                 precision: str = 'fp32',
+                 compile_forward: bool = False):
         """Implementation of MHA net which uses multihead attention
 
         Args:
             src_embed: The embedding module for the src tensor passed to the model
-            positional_encoding: The positional encoding to use. Defaults to the PositionalEncoding class implemented
-                in this module, but can be set to None to usee no positional encoding
+            positional_encoding: The positional encoding to use, either a class that is constructed with d_model or an 
+                already constructed module. Defaults to the PositionalEncoding class implemented in this module, but can 
+                be set to None to use no positional encoding
             forward_network: The forward network that follows the MHA layer. Should take the d_model, d_out, d_feedforward, and max_seq_len arguments
                 on __init__
             forward_network_opts: Dictionary of additional options to pass to the forward network. An empty dictionary is used to 
@@ -141,8 +160,13 @@ class MHANet(nn.Module):
             max_seq_len: The maximum sequence length
             device: The device to use for the model
             dtype: The datatype to use for the model
+            precision: The precision used for the forward pass in get_loss, one of 'bf16', 'fp16', or 'fp32'.
+                Reduced precisions run under torch.autocast while the loss is still computed in full precision
+            compile_forward: If True, the whole network is compiled with torch.compile so that the src forward function, 
+                attention, and forward network are captured in a single graph
         """
         assert(d_model % n_heads == 0)
+        assert(precision in PRECISION_DTYPES)
         super().__init__()
         self.src_embed = src_embed
         self.src_fwd_fn = src_forward_function
@@ -154,32 +178,93 @@ class MHANet(nn.Module):
         self.max_seq_len = max_seq_len
         self.device = device
         self.dtype = dtype
+        self.precision = precision
+        #Stored at construction so that the forward pass does not depend on isinstance checks
+        self._src_is_embedding = isinstance(src_embed, nn.Embedding)
 
-        self.pos_encoder = (lambda x : x) if positional_encoding is None else positional_encoding(d_model)
-        self.mha = nn.MultiheadAttention(d_model, n_heads, batch_first = True)
+        #The positional encoding is constructed once and registered as a submodule
+        if positional_encoding is None:
+            self.pos_encoder = NoPositionalEncoding()
+        elif isinstance(positional_encoding, nn.Module):
+            self.pos_encoder = positional_encoding
+        else:
+            self.pos_encoder = positional_encoding(d_model)
+        #Explicit attention projections so that attention can be dispatched to the fused
+        #   scaled_dot_product_attention kernels. The q, k, and v projections are fused 
+        #   into a single linear layer
+        self.qkv = nn.Linear(d_model, 3 * d_model)
+        self.out_proj = nn.Linear(d_model, d_model)
+        #Zero biases as in nn.MultiheadAttention
+        nn.init.zeros_(self.qkv.bias)
+        nn.init.zeros_(self.out_proj.bias)
         self.ffnn = forward_network(d_model, d_out, d_feedforward, max_seq_len, **forward_network_opts)
+        self._register_load_state_dict_pre_hook(self._convert_legacy_state_dict)
+        if compile_forward:
+            #Module.compile() leaves the state dictionary keys unchanged
+            self.compile(dynamic = True)
+
+    def _convert_legacy_state_dict(self, state_dict: dict, prefix: str, *args) -> None:
+        '''Converts state dictionaries saved with nn.MultiheadAttention (mha.in_proj_*, mha.out_proj.*)
+        or with separate q/k/v projections to the fused projection layout so that older checkpoints still load'''
+        for param in ['weight', 'bias']:
+            in_proj_key = f'{prefix}mha.in_proj_{param}'
+            if in_proj_key in state_dict:
+                #in_proj is already stacked as [q; k; v] along dim 0
+                state_dict[f'{prefix}qkv.{param}'] = state_dict.pop(in_proj_key)
+            split_keys = [f'{prefix}{name}_proj.{param}' for name in ['q', 'k', 'v']]
+            if all(k in state_dict for k in split_keys):
+                state_dict[f'{prefix}qkv.{param}'] = torch.cat([state_dict.pop(k) for k in split_keys], dim = 0)
+            out_proj_key = f'{prefix}mha.out_proj.{param}'
+            if out_proj_key in state_dict:
+                state_dict[f'{prefix}out_proj.{param}'] = state_dict.pop(out_proj_key)
 
     def _sanitize_forward_args(self, x: tuple[Tensor, tuple[str]]) -> Tensor:
         #Unpack the tuple
         x, _ = x
-        if isinstance(self.src_embed, nn.Embedding):
+        if self._src_is_embedding:
             x = x.long()
         return x
 
-    def forward(self, x: tuple[Tensor, tuple[str]]) -> Tensor:
+    def _attention(self, x: Tensor, attn_bias: Optional[Tensor]) -> Tensor:
+        '''Multihead self attention using F.scaled_dot_product_attention
+        Args:
+            x: Tensor, shape [batch_size, seq_len, d_model]
+            attn_bias: Additive attention bias, shape [batch_size, 1, 1, seq_len] with -inf at padded positions, or NoneType
+        '''
+        B, L, _ = x.shape
+        d_head = self.d_model // self.n_heads
+        #(N, T, E) -> (N, H, T, E/H)
+        q, k, v = self.qkv(x).chunk(3, dim = -1)
+        q = q.reshape(B, L, self.n_heads, d_head).transpose(1, 2)
+        k = k.reshape(B, L, self.n_heads, d_head).transpose(1, 2)
+        v = v.reshape(B, L, self.n_heads, d_head).transpose(1, 2)
+        if attn_bias is not None:
+            #No-op unless autocasting changed the dtype of the projections
+            attn_bias = attn_bias.to(q.dtype)
+        out = F.scaled_dot_product_attention(q, k, v, attn_mask = attn_bias, is_causal = False)
+        #(N, H, T, E/H) -> (N, T, E)
+        out = out.transpose(1, 2).reshape(B, L, self.d_model)
+        return self.out_proj(out)
+
+    def forward(self, x: tuple[Tensor, tuple[str]], return_logits: bool = False) -> Tensor:
         src = self._sanitize_forward_args(x)
         src_embedded, src_key_pad_mask = self.src_fwd_fn(src, self.d_model, self.src_embed, self.src_pad_token, self.pos_encoder)
-        x, _ = self.mha(src_embedded, 
-                        src_embedded, 
-                        src_embedded, 
-                        key_padding_mask = src_key_pad_mask)
-        return self.ffnn(x)
+        #The padding mask is converted once into the additive bias format consumed by the attention kernel
+        attn_bias = pad_mask_to_attn_bias(src_key_pad_mask, src_embedded.dtype)
+        x = self._attention(src_embedded, attn_bias)
+        return self.ffnn(x, return_logits = return_logits)
     
     def get_loss(self,
                  x: tuple[Tensor, tuple], 
                  y: tuple[Tensor], 
                  loss_fn: Callable[[Tensor, Tensor], Tensor]) -> Tensor:
-        pred = self.forward(x)
+        #Losses that take logits skip the final sigmoid for numerical stability
+        return_logits = getattr(loss_fn, 'takes_logits', False)
+        with autocast_context(self.device, self.precision):
+            #Called through __call__ so that a compiled forward is used
+            pred = self(x, return_logits = return_logits)
         y_target, = y
-        loss = loss_fn(pred, y_target.to(self.dtype).to(self.device))
+        y_target = y_target.to(device = self.device, dtype = self.dtype, non_blocking = True)
+        #Loss reduction is always done in full precision
+        loss = loss_fn(pred.to(y_target.dtype), y_target)
         return loss
\ No newline at end of file
@@ -5,6 +5,7 @@ import pickle, os
 import math
 import torch.nn.functional as F
 from typing import Optional, Any, Tuple, Callable
+from nmr.networks.forward_fxns import PRECISION_DTYPES, autocast_context
 
 class PositionalEncoding(nn.Module):
 
@@ -16,7 +17,8 @@ class PositionalEncoding(nn.Module):
 
         position = torch.arange(max_len).unsqueeze(1)
         div_term = torch.exp(torch.arange(0, d_model, 2) * (-math.log(10000.0) / d_model))
-        pe = torch.zeros(1, max_len, d_model)
+        #The table is always generated in full precision, it is only cast on .to(dtype) or when added
+        pe = torch.zeros(1, max_len, d_model, dtype = torch.float32)
         pe[0, :, 0::2] = torch.sin(position * div_term)
         pe[0, :, 1::2] = torch.cos(position * div_term)
         self.register_buffer('pe', pe)
@@ -29,10 +31,11 @@ class PositionalEncoding(nn.Module):
         '''
         #Select and expand the PE to be the right shape first
         if ind is not None:
-            added_pe = self.pe[torch.arange(1).reshape(-1, 1), ind, :]
-            x = x + added_pe
+            #Gather rows of the (max_len, d_model) table directly, (N, T) -> (N, T, E)
+            x = x + F.embedding(ind, self.pe[0]).to(x.dtype)
         else:
-            x = x + self.pe[:, :x.size(1), :]
+            #Only the used slice is cast so that reduced precision inputs are not promoted
+            x = x + self.pe[:, :x.size(1), :].to(x.dtype)
         return self.dropout(x)
     
 class Transformer(nn.Module):
@@ -47,7 +50,7 @@ class Transformer(nn.Module):
                  dim_feedforward: int = 2048, dropout: float = 0.1, activation: str = 'relu', custom_encoder: Optional[Any] = None,
                  custom_decoder: Optional[Any] = None, target_size: int = 50, source_size: int = 957,
                  layer_norm_eps: float = 1e-05, batch_first: bool = True, norm_first: bool = False, 
-                 device: torch.device = None, dtype: torch.dtype = torch.float):
+                 device: torch.device = None, dtype: torch.dtype = torch.float, precision: str = 'fp32'):
         
         r"""Most parameters are standard for the PyTorch transformer class. A few specific ones that have been added:
 
@@ -63,7 +66,10 @@ class Transformer(nn.Module):
         source_size (int): Size of the source alphabet (including start, stop, and pad tokens).
         batch_first is set to be default True, more intuitive to reason about dimensionality if batching 
             dimension is first
+        precision: The precision used for the forward pass in get_loss, one of 'bf16', 'fp16', or 'fp32'. 
+            Reduced precisions run under torch.autocast while the loss is still computed in full precision
         """
+        assert(precision in PRECISION_DTYPES)
         super().__init__()
 
         self.src_embed = src_embed
@@ -78,6 +84,10 @@ class Transformer(nn.Module):
         self.d_model = d_model
         self.dtype = dtype
         self.device = device
+        self.precision = precision
+        #Stored at construction so that the forward pass does not depend on isinstance checks
+        self._src_is_embedding = isinstance(src_embed, nn.Embedding)
+        self._tgt_is_embedding = isinstance(tgt_embed, nn.Embedding)
 
         self.transformer = nn.Transformer(d_model = d_model, nhead = nhead, num_encoder_layers = num_encoder_layers,
                                           num_decoder_layers = num_decoder_layers, dim_feedforward = dim_feedforward,
@@ -89,14 +99,18 @@ class Transformer(nn.Module):
         #Always use start and stop tokens for target, only padding is optional
         self.pos_encoder = PositionalEncoding(d_model, dropout)
         self.out = nn.Linear(d_model, target_size)
+        #Causal mask cache, grown on demand to the largest target length seen. Not persistent so 
+        #   that the state dictionary is unchanged
+        self.register_buffer('tgt_mask_cache', None, persistent = False)
 
-    def _get_tgt_mask(self, size):
+    def _get_tgt_mask(self, size: int, device: torch.device) -> Tensor:
         #Generate a mask for the target to preserve autoregressive property. Note that the mask is 
-        #   Additive for the PyTorch transformer
-        mask = torch.tril(torch.ones(size, size, dtype = self.dtype, device = self.device))
-        mask = mask.masked_fill(mask == 0, float('-inf'))
-        mask = mask.masked_fill(mask == 1, float(0.0))
-        return mask
+        #   Additive for the PyTorch transformer. The mask is built once and sliced for shorter targets
+        mask = self.tgt_mask_cache
+        if mask is None or mask.size(0) < size or mask.device != device:
+            mask = torch.full((size, size), float('-inf'), dtype = self.dtype, device = device).triu_(diagonal = 1)
+            self.tgt_mask_cache = mask
+        return mask[:size, :size]
     
     def _sanitize_forward_args(self, 
                                x: Tuple[Tensor, Tuple],
@@ -109,18 +123,22 @@ class Transformer(nn.Module):
         #Unpack the tuples
         inp, _ = x
         shifted_y, _ = y
-        if isinstance(self.src_embed, nn.Embedding):
+        if self._src_is_embedding:
             inp = inp.long()
-        if isinstance(self.tgt_embed, nn.Embedding):
+        if self._tgt_is_embedding:
             shifted_y = shifted_y.long()
         return inp, shifted_y
     
     #Sketch of what the forward function could look like with more abstraction
     def forward(self, 
                 x: Tuple[Tensor, Tuple], 
-                y: Tuple[Tensor, Tensor]) -> Tensor:
+                y: Tuple[Tensor, Tensor],
+                tgt_mask: Optional[Tensor] = None) -> Tensor:
+        '''tgt_mask is an optional precomputed additive causal mask of shape [tgt_len, tgt_len], 
+        otherwise the cached causal mask is used'''
         src, tgt = self._sanitize_forward_args(x, y)
-        tgt_mask = self._get_tgt_mask(tgt.size(1)).to(tgt.device)
+        if tgt_mask is None:
+            tgt_mask = self._get_tgt_mask(tgt.size(1), tgt.device)
         src_embedded, src_key_pad_mask = self.src_fwd_fn(src, self.d_model, self.src_embed, self.src_pad_token, self.pos_encoder)
         tgt_embedded, tgt_key_pad_mask = self.tgt_fwd_fn(tgt, self.d_model, self.tgt_embed, self.tgt_pad_token, self.pos_encoder)
         transformer_out = self.transformer(src_embedded, tgt_embedded,
@@ -144,10 +162,12 @@ class Transformer(nn.Module):
             loss_fn: The loss function to use for the model, with the signature
                 tensor, tensor -> tensor
         """
-        pred = self.forward(x, y)
-        pred = pred.permute(0, 2, 1)
+        with autocast_context(self.device, self.precision):
+            pred = self.forward(x, y)
+        #Loss reduction is always done in full precision
+        pred = pred.to(self.dtype).permute(0, 2, 1)
         _, full_y = y
-        if isinstance(self.tgt_embed, nn.Embedding):
+        if self._tgt_is_embedding:
             full_y = full_y.long()
-        loss = loss_fn(pred, full_y.to(self.device))
+        loss = loss_fn(pred, full_y.to(self.device, non_blocking = True))
         return loss
\ No newline at end of file
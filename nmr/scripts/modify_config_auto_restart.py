@@ -41,7 +41,7 @@ def main() -> None:
         print("Restart checkpoint file does not exist. No modifications made, exiting.")
         return
     print("Directory and restart checkpoint detected, modifying config file...")
-    checkpoint = torch.load(checkpoint_path, map_location = 'cpu')
+    checkpoint = torch.load(checkpoint_path, map_location = 'cpu', mmap = True)
     completed_epochs = checkpoint['epoch'] + 1
     current_config['training']['prev_epochs'] = completed_epochs
     current_config['model']['load_model'] = checkpoint_path 
@@ -74,9 +74,18 @@ def main() -> None:
     mod_ckpt_name = select_model(global_args['savedir'],
                                  inference_args['model_selection'])
     print(f"Using the model checkpoint {mod_ckpt_name}")
-    best_model_ckpt = torch.load(mod_ckpt_name, map_location = device)
+    best_model_ckpt = torch.load(mod_ckpt_name, map_location = device, mmap = True)
     model.load_state_dict(best_model_ckpt['model_state_dict'])
 
+    #Optional dynamic int8 quantization of the Linear layers, only supported on the CPU
+    if inference_args.get('quantize', False):
+        assert(device.type == 'cpu')
+        if not hasattr(model, 'quantize'):
+            raise ValueError(f"Quantization is not supported for model type {type(model).__name__}")
+        if inference_args.get('num_threads') is not None:
+            torch.set_num_threads(inference_args['num_threads'])
+        model = model.quantize()
+
     if local_rank == 0:
         #Only do this under the first process
         tot_config = {
@@ -63,7 +63,7 @@ def main() -> None:
     #Construct the model
     model, _ = create_model(model_args, dtype, device)
     model.to(dtype).to(device)
-    best_ckpt = torch.load(ckpt, map_location=device)
+    best_ckpt = torch.load(ckpt, map_location=device, mmap=True)
     model.load_state_dict(best_ckpt['model_state_dict'])
 
     #Run inference
@@ -11,7 +11,6 @@ from nmr.models import create_model
 from nmr.training import create_optimizer, fit
 import nmr.training.loss_fxns as loss_fxns
 import h5py
-import pickle as pkl
 from .top_level_utils import (
     seed_everything, 
     seed_worker, 
@@ -192,12 +191,14 @@ def main() -> None:
                 loss_metric=training_args['checkpoint_loss_metric'],
                 write_freq=training_args['write_freq'],
                 test_freq=training_args['test_freq'],
-                prev_epochs=training_args['prev_epochs']
+                prev_epochs=training_args['prev_epochs'],
+                accum_steps=training_args.get('accum_steps', 1),
+                amp_dtype=dtype_convert(training_args['amp_dtype']) if training_args.get('amp_dtype') is not None else None,
+                async_save=training_args.get('async_save', True),
+                activation_checkpointing=training_args.get('activation_checkpointing', False)
                 )
     
-    # save_train_history(global_args['savedir'], losses)
-    with open(f"{global_args['savedir']}/losses.pkl", "wb") as f:
-        pkl.dump(losses, f)
+    save_train_history(global_args['savedir'], losses)
 
 if __name__ == '__main__':
     main()
@@ -7,7 +7,6 @@ from torch.utils.data import Dataset
 import os
 import h5py
 import pickle as pkl
-from functools import reduce
 import math
 import warnings
 import re
@@ -33,7 +32,8 @@ def dtype_convert(dtype: str) -> torch.dtype:
     dtype_dict = {
         'float32': torch.float,
         'float64': torch.double,
-        'float16': torch.half
+        'float16': torch.half,
+        'bfloat16': torch.bfloat16
     }
     return dtype_dict[dtype]
 
@@ -84,38 +84,60 @@ def divide_parallel_subsets(dataset: Dataset,
         end = n_samples
     return torch.utils.data.Subset(dataset, range(start, end))
     
-def save_train_history(savedir: str, loss_obj: tuple[list, ...]) -> None:
-    """Saves the training history of the model to the specified directory
+def save_train_history(savedir: str, loss_obj: tuple[list | dict, ...]) -> None:
+    """Saves the training history of the model to losses.h5 in the specified directory
     
     Args:
         savedir: The directory to save the training history
-        loss_obj: The tuple of lists containing the training history, with
+        loss_obj: The tuple containing the training history, with
             train_losses
             val_losses
             test_losses
             model_names
             best_losses
-        in that order
+        in that order. The train, val, and test losses can either be lists or dictionaries 
+        mapping a name (e.g. train_loss_0) to a list of losses, as returned by fit()
+    
+    Loss curves are appended to those already present in losses.h5 when restarting training, 
+    while the model_names and best_losses datasets are overwritten with the current checkpoints
     """
     train_losses, val_losses, test_losses, model_names, best_losses = loss_obj
+    curves = {}
+    for name, losses in [('train_losses', train_losses), ('val_losses', val_losses), ('test_losses', test_losses)]:
+        if isinstance(losses, dict):
+            curves.update(losses)
+        else:
+            curves[name] = losses
     print("Saving losses")
-    if not os.path.isfile(f"{savedir}/losses.h5"):
-        with h5py.File(f"{savedir}/losses.h5", "w") as f:
-            f.create_dataset("train_losses", data = train_losses)
-            f.create_dataset("val_losses", data = val_losses)
-            f.create_dataset("test_losses", data = test_losses)
-    else:
-        with h5py.File(f"{savedir}/losses.h5", 'r') as f:
-            prev_train_losses = f['train_losses'][()]
-            prev_val_losses = f['val_losses'][()]
-            prev_test_losses = f['test_losses'][()]
-        with h5py.File(f"{savedir}/losses.h5", 'w') as f:
-            f.create_dataset("train_losses", data = np.concatenate([prev_train_losses, train_losses]))
-            f.create_dataset("val_losses", data = np.concatenate([prev_val_losses, val_losses]))
-            f.create_dataset("test_losses", data = np.concatenate([prev_test_losses, test_losses]))
+    with h5py.File(f"{savedir}/losses.h5", 'a') as f:
+        for name, losses in curves.items():
+            losses = np.asarray(losses)
+            if name in f:
+                losses = np.concatenate([f[name][()], losses])
+                del f[name]
+            f.create_dataset(name, data = losses)
+        for name in ['model_names', 'best_losses']:
+            if name in f:
+                del f[name]
+        f.create_dataset('model_names', data = np.array(model_names, dtype = h5py.string_dtype()))
+        f.create_dataset('best_losses', data = np.asarray(best_losses, dtype = np.float32))
+
+def load_train_history(savedir: str) -> dict[str, np.ndarray | list[str]]:
+    """Loads the training history saved by save_train_history() in a single pass over losses.h5
     
-    with open(f"{savedir}/model_names_losses.pkl", "wb") as f:
-        pkl.dump((model_names, best_losses), f)
+    Args:
+        savedir: The directory containing losses.h5
+    
+    Returns a dictionary mapping each dataset name to its contents, with model_names returned
+    as a list of python strings
+    """
+    history = {}
+    with h5py.File(f"{savedir}/losses.h5", 'r') as f:
+        for name in f.keys():
+            history[name] = f[name][()]
+    if 'model_names' in history:
+        history['model_names'] = [name.decode('utf-8') for name in history['model_names']]
+    return history
 
 def save_str_set(h5ptr: h5py.File, 
                  preds: list[tuple],
@@ -139,21 +161,15 @@ def save_str_set(h5ptr: h5py.File,
     group.create_dataset("scores", data = np.array(scores))
 
 def find_max_length(preds: list[list[np.ndarray]]) -> int:
-    flattened_preds = list(reduce(lambda x, y : x + y, preds))
-    max_len = max([len(elem) for elem in flattened_preds])
-    return max_len
+    return max(len(elem) for pred in preds for elem in pred)
 
 def pad_single_prediction(pred: list[np.ndarray],
                           max_len: int, 
                           pad_token: int) -> np.ndarray:
-    fixed_seqs = []
-    for elem in pred: 
-        padded_elem = np.pad(elem, 
-                             (0, max_len - len(elem)), 
-                             'constant', 
-                             constant_values = (pad_token,))
-        fixed_seqs.append(padded_elem)
-    return np.array(fixed_seqs)
+    fixed_seqs = np.full((len(pred), max_len), pad_token, dtype = pred[0].dtype)
+    for i, elem in enumerate(pred):
+        fixed_seqs[i, :len(elem)] = elem
+    return fixed_seqs
 
 def save_array_set(h5ptr: h5py.File, 
                    preds: list[tuple],
@@ -273,13 +289,22 @@ def select_model(savedir: str,
     if criterion not in ['lowest', 'highest']:
         warnings.warn("Assuming passed value is a model checkpoint")
         return criterion
-    if not os.path.isfile(f"{savedir}/model_names_losses.pkl"):
+    has_history = False
+    if os.path.isfile(f"{savedir}/losses.h5"):
+        with h5py.File(f"{savedir}/losses.h5", 'r') as f:
+            has_history = 'model_names' in f and 'best_losses' in f
+    if has_history:
+        print("Loading checkpoint losses from file")
+        history = load_train_history(savedir)
+        model_names, best_losses = history['model_names'], history['best_losses']
+    elif not os.path.isfile(f"{savedir}/model_names_losses.pkl"):
         print("Deducing checkpoint losses from file names")
         all_files = os.listdir(savedir)
         checkpoint_files = list(filter(lambda x : x.endswith('.pt') and x != 'RESTART_checkpoint.pt', all_files))
         model_names = [f"{savedir}/{f}" for f in checkpoint_files]
         best_losses = [extract_loss_val(f) for f in checkpoint_files]
     else:
+        #Older runs saved the checkpoint losses as a pickle
         print("Loading checkpoint losses from file")
         with open(f"{savedir}/model_names_losses.pkl", "rb") as f:
             model_names, best_losses = pkl.load(f)
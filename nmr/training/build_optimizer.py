@@ -10,6 +10,8 @@ def create_optimizer(model: nn.Module,
     optimizer_raw = getattr(optim, training_args['optimizer'])
     optimizer = optimizer_raw(model.parameters(), **training_args['optimizer_args'])
     if (model_args['load_model'] is not None) and (model_args['load_optimizer']):
+        #Not memory-mapped since the optimizer keeps the loaded state tensors, and the checkpoint file 
+        #   (usually the RESTART checkpoint) is rewritten in place during training
         ckpt = torch.load(model_args['load_model'], map_location=device)
         optimizer.load_state_dict(ckpt['optimizer_state_dict'])
     return optimizer
\ No newline at end of file
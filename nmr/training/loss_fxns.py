@@ -1,9 +1,13 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from torch import Tensor
 from typing import Optional
 
 class SubsWeightedBCELoss(nn.Module):
+    #Signals to the networks that predictions should be passed as logits
+    takes_logits = True
+
     def __init__(self,
                  weights: Optional[Tensor] = None):
         super().__init__()
@@ -15,26 +19,19 @@ class SubsWeightedBCELoss(nn.Module):
         '''
         Computes the weighted BCE Loss with a different 0/1 class weight per substructure. 
 
-        y_pred: (batch_size, num_substructures), the predicted probabilities for each substructure
+        y_pred: (batch_size, num_substructures), the predicted logits for each substructure
         y_true: (batch_size, num_substructures), the true substructures present in each molecule
         weights: (batch_size, num_substructures, 2), the weights for each substructure. Each row i represents the 
             0 and 1 weight for substructure i. If weights are not given, then the loss is unweighted.
         reduction: The method for reducing the loss. Defaults to 'mean', but can be 'mean' or 'sum'.
         '''
-        criterion = nn.BCELoss(reduction = 'none')
-        unweighted_loss = criterion(y_pred, y_true)
-        #Compute the weight for each substructure now
+        #Select the 0/1 weight for each substructure
         if self.weights is not None:
-            w = y_true * self.weights[:,:, 1] + (1 - y_true) * self.weights[:,:, 0]
-            weighted_loss = w * unweighted_loss
+            w = torch.where(y_true > 0.5, self.weights[..., 1], self.weights[..., 0])
         else:
-            weighted_loss = 1 * unweighted_loss
-        #Averaged across substructures
-        rowwise_meaned = torch.mean(weighted_loss, dim = 0)
-        assert(rowwise_meaned.shape == (957,))
-        #Sum for total loss
-        tot_loss = torch.sum(rowwise_meaned)
-        return tot_loss
+            w = None
+        #Averaging over the batch and summing over substructures is a sum divided by the batch size
+        return F.binary_cross_entropy_with_logits(y_pred, y_true, weight = w, reduction = 'sum') / y_true.size(0)
 
 CrossEntropyLoss = nn.CrossEntropyLoss
 BCELoss = nn.BCELoss
@@ -2,19 +2,215 @@ import numpy as np
 import pickle, os, shutil
 import torch
 import torch.nn as nn
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
 from torch import Tensor
 from typing import Callable, Optional
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor, Future
 import re
+import heapq
+import math
+from functools import partial
+from nmr.networks.forward_fxns import PRECISION_DTYPES
+
+def compile_enabled() -> bool:
+    """Whether torch.compile is enabled for training, set through the NMR_COMPILE=1 environment variable.
+    Compilation is opt-in because of the compile latency on the first steps"""
+    return os.environ.get('NMR_COMPILE', '0') == '1'
+
+def get_optimizer_step(optimizer: torch.optim.Optimizer) -> Callable[[], None]:
+    """Returns the function used to step the optimizer. If compilation is enabled and the GPU has compute 
+    capability >= 7.0, the step is compiled so that the per-parameter updates are fused. The compiled step is 
+    cached on the optimizer so that it is reused across epochs and calls to fit().
+
+    While the compiled step is used, the learning rates are held as tensors so that scheduler updates do not 
+    trigger recompilation. restore_float_lrs() has to be called once stepping is done
+    """
+    if not (compile_enabled() and torch.cuda.is_available() and torch.cuda.get_device_capability() >= (7, 0)):
+        return optimizer.step
+    if not hasattr(optimizer, '_compiled_step'):
+        optimizer._lr_tensors = [torch.tensor(group['lr']) for group in optimizer.param_groups]
+        optimizer._compiled_step = torch.compile(optimizer.step, fullgraph = False)
+    #The same tensors are reused on every call so that the compiled step is not invalidated
+    for group, lr in zip(optimizer.param_groups, optimizer._lr_tensors):
+        if not isinstance(group['lr'], Tensor):
+            lr.fill_(group['lr'])
+            group['lr'] = lr
+    return optimizer._compiled_step
+
+def restore_float_lrs(optimizer: torch.optim.Optimizer) -> None:
+    """Converts tensor learning rates set by get_optimizer_step() back to floats so that they do not end up in 
+    saved optimizer states or carry over into later uncompiled runs"""
+    for group in optimizer.param_groups:
+        if isinstance(group['lr'], Tensor):
+            group['lr'] = group['lr'].item()
+
+def enable_activation_checkpointing(model: nn.Module) -> int:
+    """Wraps every transformer encoder and decoder layer of the model in place so that its activations are 
+    recomputed during the backward pass instead of being stored, and returns the number of wrapped layers.
+    
+    The non-reentrant implementation is used since it supports the keyword arguments passed by nn.TransformerEncoder 
+    and nn.TransformerDecoder. The RNG state is preserved so that dropout masks match between the forward pass and 
+    the recomputation. The wrapper strips its prefix from the state dictionary keys, so checkpoints are unaffected
+    """
+    from torch.distributed.algorithms._checkpoint.checkpoint_wrapper import (
+        apply_activation_checkpointing, checkpoint_wrapper, CheckpointImpl, CheckpointWrapper
+    )
+    layer_types = (nn.TransformerEncoderLayer, nn.TransformerDecoderLayer)
+    #Layers wrapped by a previous call to fit() are not wrapped again
+    already_wrapped = {id(m._checkpoint_wrapped_module) for m in model.modules() if isinstance(m, CheckpointWrapper)}
+    apply_activation_checkpointing(model,
+                                   checkpoint_wrapper_fn = partial(checkpoint_wrapper, checkpoint_impl = CheckpointImpl.NO_REENTRANT),
+                                   check_fn = lambda m: isinstance(m, layer_types) and id(m) not in already_wrapped)
+    return sum(isinstance(m, layer_types) for m in model.modules())
+
+class GetLossModule(nn.Module):
+    """Exposes the get_loss() method of a model as forward(), since DistributedDataParallel only 
+    sets up gradient synchronization for computations that go through forward()"""
+
+    def __init__(self, model: nn.Module):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x: tuple, y: tuple, loss_fn: Callable[[Tensor, Tensor], Tensor]) -> Tensor:
+        return self.model.get_loss(x, y, loss_fn)
+
+class DistributedModel(DistributedDataParallel):
+    """DistributedDataParallel over a GetLossModule with the get_loss() interface used by the training loops"""
+
+    @property
+    def get_loss(self) -> Callable[[tuple, tuple, Callable[[Tensor, Tensor], Tensor]], Tensor]:
+        #The wrapper itself has the get_loss signature, which avoids an extra Python frame per batch
+        return self
+
+def average_across_ranks(total: Tensor, count: int) -> float:
+    """Averages a summed loss over the batches of all processes when running distributed, otherwise over the 
+    batches of this process. This is a collective call, so every rank must make it even if its dataloader is 
+    empty, in which case it contributes a count of 0. Returns 0 if there are no batches on any rank
+    """
+    if dist.is_available() and dist.is_initialized():
+        stats = torch.stack([total.to(device = torch.cuda.current_device(), dtype = torch.float64),
+                             torch.tensor(count, dtype = torch.float64, device = torch.cuda.current_device())])
+        dist.all_reduce(stats, op = dist.ReduceOp.SUM)
+        total, count = stats.tolist()
+    else:
+        total = total.item()
+    return total / count if count > 0 else 0
+
+class CUDAPrefetcher:
+    """Iterates over a dataloader while copying the next batch to the device on a side stream, which overlaps
+    the host to device copy with the computation on the current batch. Batches can be nested tuples or lists
+    of tensors and other objects (e.g. SMILES strings), only the tensors are moved. For non-CUDA devices the
+    batches of the dataloader are passed through unchanged.
+    
+    The copies are only asynchronous if the dataloader returns pinned CPU tensors, tensors that are already 
+    on the device are not copied
+    """
+
+    def __init__(self, loader: torch.utils.data.DataLoader, device: torch.device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(device = self.device) if self.device.type == 'cuda' else None
+
+    def __len__(self) -> int:
+        return len(self.loader)
+
+    def _to_device(self, batch):
+        if isinstance(batch, Tensor):
+            return batch.to(self.device, non_blocking = True)
+        elif isinstance(batch, (tuple, list)):
+            return type(batch)(self._to_device(elem) for elem in batch)
+        return batch
+
+    def _record_stream(self, batch, stream: torch.cuda.Stream) -> None:
+        #Marks tensors as used by the compute stream so their memory is not reused by the copy stream too early
+        if isinstance(batch, Tensor) and batch.is_cuda:
+            batch.record_stream(stream)
+        elif isinstance(batch, (tuple, list)):
+            for elem in batch:
+                self._record_stream(elem, stream)
+
+    def _preload(self, loader_iter):
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return self._to_device(batch)
+
+    def __iter__(self):
+        if self.stream is None:
+            yield from self.loader
+            return
+        loader_iter = iter(self.loader)
+        next_batch = self._preload(loader_iter)
+        while next_batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            batch = next_batch
+            self._record_stream(batch, current_stream)
+            #Start copying the following batch before handing over the current one
+            next_batch = self._preload(loader_iter)
+            yield batch
+
+def flush_step_losses(loss_buffer: list[Tensor],
+                      writer: Optional[torch.utils.tensorboard.SummaryWriter],
+                      tag: str,
+                      first_step: int) -> list[float]:
+    """Copies the buffered step losses to the host in a single transfer and logs them to the writer
+    Args:
+        loss_buffer: List of detached scalar loss tensors, cleared after flushing
+        writer: Tensorboard writer for logging the step losses, None to disable logging
+        tag: The tensorboard tag for the step losses
+        first_step: The global step of the first loss in the buffer
+    """
+    if len(loss_buffer) == 0:
+        return []
+    losses = torch.stack(loss_buffer).cpu().tolist()
+    loss_buffer.clear()
+    if writer is not None:
+        for i, loss in enumerate(losses):
+            writer.add_scalar(tag, loss, first_step + i)
+    return losses
+
+def train_step(model: nn.Module,
+               get_loss: Callable[[tuple, tuple, Callable], Tensor],
+               x: tuple,
+               y: tuple,
+               loss_fn: Callable[[Tensor, Tensor], Tensor],
+               scaler: Optional[torch.amp.GradScaler] = None,
+               group_size: int = 1,
+               sync_grads: bool = True) -> Tensor:
+    """Runs the forward and backward pass for a single training batch and returns the detached loss
+    
+    get_loss is the model's get_loss method, bound once by the caller to avoid the attribute lookup on 
+    every batch. The loss is divided by group_size, the number of batches in the current accumulation group, 
+    before the backward pass. The optimizer step is left to the caller since it only happens on accumulation boundaries. If 
+    sync_grads is False, the model must be wrapped in DistributedDataParallel and the gradient 
+    all-reduce is skipped with no_sync(). DDP prepares the reduction during its forward pass, so both 
+    the forward and the backward pass run inside no_sync()
+    """
+    with (nullcontext() if sync_grads else model.no_sync()):
+        loss = get_loss(x, y, loss_fn)
+        if scaler is not None:
+            scaler.scale(loss / group_size).backward()
+        else:
+            (loss / group_size).backward()
+    return loss.detach()
 
 def train_loop(model: nn.Module, 
                dataloader: torch.utils.data.DataLoader, 
                loss_fn: Callable[[Tensor, Tensor], Tensor], 
                optimizer: torch.optim.Optimizer, 
                epoch: int, 
-               writer: torch.utils.tensorboard.SummaryWriter, 
+               writer: Optional[torch.utils.tensorboard.SummaryWriter], 
                scheduler: Optional[torch.optim.lr_scheduler.LambdaLR], 
                write_freq: int = 100,
-               write_tag: str = "") -> float:
+               write_tag: str = "",
+               scaler: Optional[torch.amp.GradScaler] = None,
+               accum_steps: int = 1) -> float:
     """Model training loop
     Args:
         model: The model to train
@@ -23,40 +219,126 @@ def train_loop(model: nn.Module,
             tensor, tensor -> tensor
         optimizer: The optimizer for training the model
         epoch: The current epoch
-        writer: Tensorboard writer for logging losses and learning rates
+        writer: Tensorboard writer for logging losses and learning rates, None to disable logging
         scheduler: The optional learning rate scheduler
-        write_freq: The frequency for printing loss information
+        write_freq: The frequency for printing loss information, values <= 0 disable printing
         write_tag: For naming unique losses in the tensorboard writer
+        scaler: The optional gradient scaler used when training with fp16 precision
+        accum_steps: The number of batches to accumulate gradients over before each optimizer step
     """
-    tot_loss = 0
     model.train()
-    for ibatch, (x, y) in enumerate(dataloader):
+    #The gradient scaler steps the optimizer itself, so the compiled step is only used without it
+    optimizer_step = get_optimizer_step(optimizer) if scaler is None else None
+    is_ddp = isinstance(model, DistributedDataParallel)
+    optimizer.zero_grad(set_to_none = True)
+    device = next(model.parameters()).device
+    #Bound once so that the compiled get_loss set by fit() is also picked up
+    get_loss = model.get_loss
+    #The epoch loss is accumulated on the device so that it is only synchronized once at the end
+    tot_loss = torch.zeros((), device = device)
+    loss_buffer = []
+    buffer_start = int(epoch * len(dataloader))
+    for ibatch, (x, y) in enumerate(CUDAPrefetcher(dataloader, device)):
         inner_step = int(( epoch * len(dataloader)) + ibatch)
-        loss = model.get_loss(x,y,loss_fn) 
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-        #Step the learning rate scheduler too based on the current optimizer step
-        if scheduler is not None:
-            scheduler.step()
-        if (ibatch % write_freq == 0):
-            print(f"Epoch: {epoch}\tBatch:{ibatch}\tTrain Loss{write_tag}: {loss.item()}")
-        tot_loss += loss.item()
-        writer.add_scalar(f"Training Step Loss{write_tag}", loss.item(), inner_step)
+        #Gradients are only all-reduced across processes on the batch that completes an accumulation
+        is_accum_boundary = ((ibatch + 1) % accum_steps == 0) or (ibatch + 1 == len(dataloader))
+        #The last group of the epoch can be smaller than accum_steps
+        group_start = (ibatch // accum_steps) * accum_steps
+        group_size = min(accum_steps, len(dataloader) - group_start)
+        loss = train_step(model, get_loss, x, y, loss_fn, scaler, group_size, 
+                          sync_grads = (not is_ddp) or is_accum_boundary)
+        if is_accum_boundary:
+            if scaler is not None:
+                scaler.step(optimizer)
+                scaler.update()
+            else:
+                optimizer_step()
+            optimizer.zero_grad(set_to_none = True)
+            #Step the learning rate scheduler too based on the current optimizer step
+            if scheduler is not None:
+                scheduler.step()
+        #Step losses stay on the device and are only synchronized when printing. The buffered copy
+        #   is cloned since outputs of a CUDA graph replay are overwritten by the next replay
+        tot_loss += loss
+        loss_buffer.append(loss.clone())
+        if (write_freq > 0) and (ibatch % write_freq == 0):
+            step_losses = flush_step_losses(loss_buffer, writer, f"Training Step Loss{write_tag}", buffer_start)
+            buffer_start = inner_step + 1
+            print(f"Epoch: {epoch}\tBatch:{ibatch}\tTrain Loss{write_tag}: {step_losses[-1]}")
+    flush_step_losses(loss_buffer, writer, f"Training Step Loss{write_tag}", buffer_start)
+    #Learning rates are floats again before checkpointing
+    restore_float_lrs(optimizer)
   
-    if len(dataloader) > 0:
-        writer.add_scalar(f"Avg. Epoch Train Loss{write_tag}", tot_loss / len(dataloader), epoch)
-        return tot_loss / len(dataloader)   
-    else:
-        writer.add_scalar(f"Avg. Epoch Train Loss{write_tag}", 0, epoch)
-        return 0
+    #Losses are averaged over all processes when running distributed so that every rank reports the same value. 
+    #   This is called even for an empty dataloader so that the collective does not hang the other ranks
+    avg_loss = average_across_ranks(tot_loss, len(dataloader))
+    if writer is not None:
+        writer.add_scalar(f"Avg. Epoch Train Loss{write_tag}", avg_loss, epoch)
+    return avg_loss
    
 
+def eval_step(get_loss: Callable[[tuple, tuple, Callable], Tensor],
+              x: tuple,
+              y: tuple,
+              loss_fn: Callable[[Tensor, Tensor], Tensor]) -> Tensor:
+    """Computes the loss of a single evaluation batch using the bound get_loss method of the model. No autograd 
+    graph is recorded, which also keeps a compiled get_loss from compiling training graphs for evaluation
+    """
+    with torch.no_grad():
+        return get_loss(x, y, loss_fn)
+
+def evaluation_loop(model: nn.Module, 
+                    dataloader: torch.utils.data.DataLoader, 
+                    loss_fn: Callable[[Tensor, Tensor], Tensor], 
+                    epoch: int, 
+                    writer: Optional[torch.utils.tensorboard.SummaryWriter], 
+                    write_freq: int = 100,
+                    write_tag: str = "",
+                    stage: str = "Validation") -> float:
+    """Shared loop for evaluating the model without gradient updates, used by validation_loop() and test_loop()
+    Args:
+        model: The model to evaluate
+        dataloader: The dataloader for the evaluation dataset
+        loss_fn: The loss function to use for the model, with the signature
+            tensor, tensor -> tensor
+        epoch: The current epoch
+        writer: Tensorboard writer for logging losses and learning rates, None to disable logging
+        write_freq: The frequency for printing loss information, values <= 0 disable printing
+        write_tag: For naming unique losses in the tensorboard writer
+        stage: The name of the evaluation stage used for printing and logging, e.g. 'Validation' or 'Test'
+    """
+    model.eval()
+    device = next(model.parameters()).device
+    get_loss = model.get_loss
+    #The epoch loss is accumulated on the device so that it is only synchronized once at the end
+    tot_loss = torch.zeros((), device = device)
+    loss_buffer = []
+    buffer_start = int(epoch * len(dataloader))
+    for ibatch, (x, y) in enumerate(CUDAPrefetcher(dataloader, device)):
+        inner_step = int(( epoch * len(dataloader)) + ibatch)
+        loss = eval_step(get_loss, x, y, loss_fn)
+        #Step losses stay on the device and are only synchronized when printing. The buffered copy
+        #   is cloned since outputs of a CUDA graph replay are overwritten by the next replay
+        tot_loss += loss
+        loss_buffer.append(loss.clone())
+        if (write_freq > 0) and (ibatch % write_freq == 0):
+            step_losses = flush_step_losses(loss_buffer, writer, f"{stage} Step Loss{write_tag}", buffer_start)
+            buffer_start = inner_step + 1
+            print(f"Epoch: {epoch}\tBatch:{ibatch}\t{stage} Loss{write_tag}: {step_losses[-1]}")
+    flush_step_losses(loss_buffer, writer, f"{stage} Step Loss{write_tag}", buffer_start)
+    
+    #Losses are averaged over all processes when running distributed so that every rank reports the same value. 
+    #   This is called even for an empty dataloader so that the collective does not hang the other ranks
+    avg_loss = average_across_ranks(tot_loss, len(dataloader))
+    if writer is not None:
+        writer.add_scalar(f"Avg. Epoch {stage} Loss{write_tag}", avg_loss, epoch)
+    return avg_loss
+
 def validation_loop(model: nn.Module, 
                     dataloader: torch.utils.data.DataLoader, 
                     loss_fn: Callable[[Tensor, Tensor], Tensor], 
                     epoch: int, 
-                    writer: torch.utils.tensorboard.SummaryWriter, 
+                    writer: Optional[torch.utils.tensorboard.SummaryWriter], 
                     write_freq: int = 100,
                     write_tag: str="") -> float:
     """Model validation loop
@@ -66,33 +348,18 @@ def validation_loop(model: nn.Module,
         loss_fn: The loss function to use for the model, with the signature
             tensor, tensor -> tensor
         epoch: The current epoch
-        writer: Tensorboard writer for logging losses and learning rates
-        write_freq: The frequency for printing loss information
+        writer: Tensorboard writer for logging losses and learning rates, None to disable logging
+        write_freq: The frequency for printing loss information, values <= 0 disable printing
         write_tag: For naming unique losses in the tensorboard writer
     """
-    tot_loss = 0
-    model.eval()
-    for ibatch, (x, y) in enumerate(dataloader):
-        inner_step = int(( epoch * len(dataloader)) + ibatch)
-        loss = model.get_loss(x,y,loss_fn).detach()
-        if (ibatch % write_freq == 0):
-            print(f"Epoch: {epoch}\tBatch:{ibatch}\tValidation Loss{write_tag}: {loss.item()}")
-        tot_loss += loss.item()
-        writer.add_scalar(f"Validation Step Loss{write_tag}", loss.item(), inner_step)
-    
-    if len(dataloader) > 0:
-        writer.add_scalar(f"Avg. Epoch Validation Loss{write_tag}", tot_loss / len(dataloader), epoch)
-        return tot_loss / len(dataloader)
-    else:
-        writer.add_scalar(f"Avg. Epoch Validation Loss{write_tag}", 0, epoch)
-        return 0
+    return evaluation_loop(model, dataloader, loss_fn, epoch, writer, write_freq, write_tag, stage = "Validation")
 
 
 def test_loop(model: nn.Module, 
                 dataloader: torch.utils.data.DataLoader, 
                 loss_fn: Callable[[Tensor, Tensor], Tensor], 
                 epoch: int, 
-                writer: torch.utils.tensorboard.SummaryWriter, 
+                writer: Optional[torch.utils.tensorboard.SummaryWriter], 
                 write_freq: int = 100,
                 write_tag: str="") -> float:
     """Model test loop
@@ -102,27 +369,31 @@ def test_loop(model: nn.Module,
         loss_fn: The loss function to use for the model, with the signature
             tensor, tensor -> tensor
         epoch: The current epoch
-        writer: Tensorboard writer for logging losses and learning rates
-        write_freq: The frequency for printing loss information
+        writer: Tensorboard writer for logging losses and learning rates, None to disable logging
+        write_freq: The frequency for printing loss information, values <= 0 disable printing
         write_tag: For naming unique losses in the tensorboard writer
     """
-    tot_loss = 0
-    model.eval()
-    for ibatch, (x, y) in enumerate(dataloader):
-        inner_step = int(( epoch * len(dataloader)) + ibatch)
-        loss = model.get_loss(x,y,loss_fn).detach()
-        if (ibatch % write_freq == 0):
-            print(f"Epoch: {epoch}\tBatch:{ibatch}\tTest Loss{write_tag}: {loss.item()}")
-        tot_loss += loss.item()
-        writer.add_scalar(f"Test Step Loss{write_tag}", loss.item(), inner_step)
-    
-    if len(dataloader) > 0:
-        writer.add_scalar(f"Avg. Epoch Test Loss{write_tag}", tot_loss / len(dataloader), epoch)
-        return tot_loss / len(dataloader)
-    else:
-        writer.add_scalar(f"Avg. Epoch Test Loss{write_tag}", 0, epoch)
-        return 0
+    return evaluation_loop(model, dataloader, loss_fn, epoch, writer, write_freq, write_tag, stage = "Test")
+
+
+def copy_to_cpu(state):
+    """Recursively copies all tensors in a (nested) state dictionary to new cpu tensors"""
+    if isinstance(state, Tensor):
+        return state.detach().to('cpu', copy = True)
+    elif isinstance(state, dict):
+        return {k : copy_to_cpu(v) for k, v in state.items()}
+    elif isinstance(state, (list, tuple)):
+        return type(state)(copy_to_cpu(v) for v in state)
+    return state
 
+def wait_for_checkpoints(pending: list[Future]) -> None:
+    """Waits for the pending background checkpoint operations and clears the list. The exception of a failed 
+    operation is re-raised so that the checkpoint bookkeeping never refers to a file that was not written or deleted"""
+    try:
+        for future in pending:
+            future.result()
+    finally:
+        pending.clear()
 
 def save_model(model: nn.Module, 
                optim: torch.optim.Optimizer, 
@@ -130,7 +401,9 @@ def save_model(model: nn.Module,
                epoch: int, 
                loss_metric: float, 
                savedir: str, 
-               savename: str = None) -> str:
+               savename: str = None,
+               executor: Optional[ThreadPoolExecutor] = None,
+               pending: Optional[list[Future]] = None) -> str:
     """Save model and optimizer state dicts to file
     Args:
         model: The model to save
@@ -141,24 +414,42 @@ def save_model(model: nn.Module,
         savedir: The directory to save the model and optimizer state dicts
         savename: The name to save for the checkpoint. If None, then the default format
             for saving models is used: model_epoch={epoch}_loss={loss_metric:.8f}.pt
+        executor: If given, the states are copied to the cpu and the checkpoint is written to disk
+            in the background by the executor
+        pending: The list that the future of the background write is appended to, required with an executor. 
+            The caller is responsible for waiting on it with wait_for_checkpoints()
     """
     if savename is None:
         savename = f'{savedir}/model_epoch={epoch}_loss={loss_metric:.8f}.pt'
     else:
         savename = savename
-    torch.save({'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optim.state_dict(),
-                'scheduler_state_dict' : scheduler.state_dict() if scheduler is not None else None,
-                'epoch' : epoch},
-                savename)
+    checkpoint = {'model_state_dict': model.state_dict(),
+                  'optimizer_state_dict': optim.state_dict(),
+                  'scheduler_state_dict' : scheduler.state_dict() if scheduler is not None else None,
+                  'epoch' : epoch}
+    if executor is None:
+        torch.save(checkpoint, savename)
+    else:
+        #The snapshot is taken synchronously so that training can modify the states while the checkpoint is written
+        assert(pending is not None)
+        pending.append(executor.submit(torch.save, copy_to_cpu(checkpoint), savename))
     return savename
     
-def delete_checkpoint(checkpoint: str) -> None:
+def delete_checkpoint(checkpoint: str, 
+                      executor: Optional[ThreadPoolExecutor] = None, 
+                      pending: Optional[list[Future]] = None) -> None:
     """Delete a checkpoint file
     Args:
         checkpoint: The path to the checkpoint file
+        executor: If given, the file is deleted in the background by the executor. With a single worker, 
+            this happens after all previously submitted saves have finished
+        pending: The list that the future of the background deletion is appended to, required with an executor
     """
-    os.remove(checkpoint)
+    if executor is None:
+        os.remove(checkpoint)
+    else:
+        assert(pending is not None)
+        pending.append(executor.submit(os.remove, checkpoint))
 
 def extract_loss_val(checkpoint_name: str) -> float:
     """Extract loss value from a checkpoint name"""
@@ -188,7 +479,14 @@ def fit(model: nn.Module,
         loss_metric: str = 'val',
         write_freq: int = 100,
         test_freq: int = 10,
-        prev_epochs: int = 0) -> tuple[list, list, list, list]:
+        prev_epochs: int = 0,
+        rank: int = 0,
+        world_size: int = 1,
+        distributed: bool = False,
+        accum_steps: int = 1,
+        amp_dtype: Optional[torch.dtype] = None,
+        async_save: bool = True,
+        activation_checkpointing: bool = False) -> tuple[list, list, list, list]:
     """Model training loop
 
     Args:
@@ -205,112 +503,223 @@ def fit(model: nn.Module,
         scheduler: The optional learning rate scheduler
         top_checkpoints_n: The number of top checkpoints to save
         loss_metric: The criterion to use for saving checkpoints. Can be 'val' or 'train'
-        write_freq: The frequency for printing loss information
+        write_freq: The frequency for printing loss information, values <= 0 disable printing
         test_freq: The frequency for running the test loop of the model
         prev_epochs: The number of epochs that have already been trained for. This is used
             for loading checkpoints
+        rank: The rank of this process, also used as its CUDA device index when running distributed. The model 
+            must already be constructed on that device
+        world_size: The total number of processes when running distributed
+        distributed: Whether to train with DistributedDataParallel. The training dataloaders must use a 
+            DistributedSampler, and only rank 0 logs to the writer and saves or deletes checkpoints. The gradient 
+            bucket size in MB can be set with the NMR_DDP_BUCKET_MB environment variable (default 50)
+        accum_steps: The number of batches to accumulate gradients over before each optimizer step
+        amp_dtype: The optional reduced precision dtype (torch.bfloat16 or torch.float16) for the forward pass in 
+            all loops. It overrides the precision of every network in the model for the duration of fit(), so only the 
+            network forward pass is autocast and the loss is still computed in full precision. A gradient scaler is 
+            used for torch.float16
+        async_save: Whether to write and delete checkpoints in a background thread. All checkpoint 
+            operations have finished when fit() returns
+        activation_checkpointing: Whether to recompute the activations of the transformer layers during the backward 
+            pass to reduce memory usage at the cost of extra compute, allowing larger batch sizes. Composes with 
+            autocasting and with the compiled get_loss, which is compiled without fullgraph. The layers remain 
+            wrapped after fit() returns
     """
     assert len(train_dataloaders) == len(val_dataloaders) == len(test_dataloaders)
     existing_files, existing_losses = determine_existing_checkpoints(save_dir)
     assert(len(existing_files) == len(existing_losses))
-    best_losses = np.concatenate((np.ones(top_checkpoints_n - len(existing_losses)) * np.inf, np.array(existing_losses)))
-    model_names = [None] * (top_checkpoints_n - len(existing_files)) + existing_files
-    train_metrics = {
-        f'train_loss_{x}' : [] for x in range(len(train_dataloaders))
-    }
-    val_metrics = {
-        f'val_loss_{x}' : [] for x in range(len(val_dataloaders))
-    }
-    test_metrics = {
-        f'test_loss_{x}' : [] for x in range(len(test_dataloaders))
-    }
-    for epoch in range(nepochs):
-        true_epoch = epoch + prev_epochs
-
-        #Train loss computations
-        for i_train, train_dloader in enumerate(train_dataloaders):
-            train_loss = train_loop(model, 
-                                    train_dloader, 
-                                    loss_fn, 
-                                    optimizer, 
-                                    true_epoch, 
-                                    writer, 
-                                    scheduler, 
-                                    write_freq,
-                                    write_tag=f" {i_train}")
-            train_metrics[f'train_loss_{i_train}'].append(train_loss)
-        #Validation loss computations
-        for i_val, val_dloader in enumerate(val_dataloaders):
-            val_loss = validation_loop(model, 
-                                    val_dloader, 
-                                    loss_fn, 
-                                    true_epoch, 
-                                    writer, 
-                                    write_freq,
-                                    write_tag = f" {i_val}")
-            val_metrics[f"val_loss_{i_val}"].append(val_loss)
-        if true_epoch % test_freq == 0:
-            #Test loss calculation
-            for i_tst, tst_dloader in enumerate(test_dataloaders):
-                test_loss = test_loop(model,
-                                    tst_dloader,
-                                    loss_fn,
-                                    true_epoch,
-                                    writer,
-                                    write_freq,
-                                    write_tag = f" {i_tst}")
-                test_metrics[f"test_loss_{i_tst}"].append(test_loss)
+    #Max-heap of the kept checkpoints stored as (-loss, counter, name) so that the worst kept checkpoint
+    #   is at the top. The counter breaks ties between equal losses
+    checkpoint_heap = [(-loss, i, name) for i, (name, loss) in enumerate(zip(existing_files, existing_losses))]
+    heapq.heapify(checkpoint_heap)
+    checkpoint_counter = len(checkpoint_heap)
+    last_tested_epoch = None
+    #Losses are stored in preallocated (n_datasets, n_entries) arrays and converted to the metric dictionaries 
+    #   at the end. The test loop runs at most nepochs // test_freq + 1 times periodically plus once at the end
+    train_names = [f'train_loss_{x}' for x in range(len(train_dataloaders))]
+    val_names = [f'val_loss_{x}' for x in range(len(val_dataloaders))]
+    test_names = [f'test_loss_{x}' for x in range(len(test_dataloaders))]
+    train_losses = np.empty((len(train_dataloaders), nepochs))
+    val_losses = np.empty((len(val_dataloaders), nepochs))
+    test_losses = np.empty((len(test_dataloaders), nepochs // test_freq + 2))
+    n_tests = 0
+    #Let cuDNN autotune the convolution algorithms, the spectra inputs to the convolutional layers have a fixed shape
+    if any(isinstance(m, (nn.Conv1d, nn.Conv2d)) for m in model.modules()):
+        torch.backends.cudnn.benchmark = True
+    #The networks autocast their own forward pass in get_loss, so amp_dtype is applied through their precision
+    precision_modules = [m for m in model.modules() if isinstance(getattr(m, 'precision', None), str)]
+    original_precisions = [m.precision for m in precision_modules]
+    if amp_dtype is not None:
+        if len(precision_modules) == 0:
+            raise ValueError(f"amp_dtype is not supported for {type(model).__name__}, which has no forward pass precision")
+        amp_precision = next(k for k, v in PRECISION_DTYPES.items() if v == amp_dtype)
+        for m in precision_modules:
+            m.precision = amp_precision
+    #fp16 forward passes need loss scaling to avoid gradient underflow
+    if any(m.precision == 'fp16' for m in precision_modules):
+        scaler = torch.amp.GradScaler('cuda')
+    else:
+        scaler = None
+    if activation_checkpointing:
+        n_wrapped = enable_activation_checkpointing(model)
+        print(f"Activation checkpointing enabled for {n_wrapped} transformer layers")
+    #The loops call model.get_loss directly, so the bound get_loss is compiled rather than the module. 
+    #   The instance attribute shadows the method and leaves the model and its state dictionary untouched 
+    #   for checkpointing. Dynamic shapes avoid recompiling for every sequence length
+    if compile_enabled():
+        model.get_loss = torch.compile(model.get_loss, mode = 'reduce-overhead', dynamic = True)
+    #Training steps go through the DDP wrapper so gradients are all-reduced during the backward pass, 
+    #   evaluation and checkpointing use the underlying model
+    is_main_process = (not distributed) or rank == 0
+    initialized_process_group = False
+    train_model = model
+    if distributed:
+        if not dist.is_initialized():
+            dist.init_process_group(backend = 'nccl', rank = rank, world_size = world_size)
+            initialized_process_group = True
+        torch.cuda.set_device(rank)
+        #The networks move their targets to the device stored at construction, so the model has to be built 
+        #   on this rank's device rather than moved here
+        rank_device = torch.device('cuda', rank)
+        assert(next(model.parameters()).device == rank_device)
+        assert(all(torch.device(m.device) == rank_device for m in model.modules() if getattr(m, 'device', None) is not None))
+        #The networks use the same parameters on every step, so the static graph lets DDP reuse its reduction 
+        #   schedule after the first iteration. Gradients are views into the communication buckets to avoid a copy
+        train_model = DistributedModel(GetLossModule(model), 
+                                       device_ids = [rank], 
+                                       bucket_cap_mb = int(os.environ.get('NMR_DDP_BUCKET_MB', '50')),
+                                       static_graph = True,
+                                       gradient_as_bucket_view = True)
+        if not is_main_process:
+            writer = None
+    #A single worker keeps the checkpoint writes and deletions in submission order
+    executor = ThreadPoolExecutor(max_workers = 1) if async_save else None
+    pending_checkpoints = []
+    try:
+        for epoch in range(nepochs):
+            true_epoch = epoch + prev_epochs
+
+            #Train loss computations
+            for i_train, train_dloader in enumerate(train_dataloaders):
+                if distributed and len(train_dloader) > 0:
+                    assert(isinstance(train_dloader.sampler, DistributedSampler))
+                    #Reshuffle the shards of each rank every epoch
+                    train_dloader.sampler.set_epoch(true_epoch)
+                train_loss = train_loop(train_model, 
+                                        train_dloader, 
+                                        loss_fn, 
+                                        optimizer, 
+                                        true_epoch, 
+                                        writer, 
+                                        scheduler, 
+                                        write_freq,
+                                        write_tag=f" {i_train}",
+                                        scaler=scaler,
+                                        accum_steps=accum_steps)
+                train_losses[i_train, epoch] = train_loss
+            #Validation loss computations
+            for i_val, val_dloader in enumerate(val_dataloaders):
+                val_loss = validation_loop(model, 
+                                        val_dloader, 
+                                        loss_fn, 
+                                        true_epoch, 
+                                        writer, 
+                                        write_freq,
+                                        write_tag = f" {i_val}")
+                val_losses[i_val, epoch] = val_loss
+            if true_epoch % test_freq == 0:
+                #Test loss calculation
+                for i_tst, tst_dloader in enumerate(test_dataloaders):
+                    test_loss = test_loop(model,
+                                        tst_dloader,
+                                        loss_fn,
+                                        true_epoch,
+                                        writer,
+                                        write_freq,
+                                        write_tag = f" {i_tst}")
+                    test_losses[i_tst, n_tests] = test_loss
+                n_tests += 1
+                last_tested_epoch = true_epoch
         
-        if 'train' in loss_metric:
-            curr_k_metric_value = train_metrics[loss_metric][-1]
-        elif 'val' in loss_metric:
-            curr_k_metric_value = val_metrics[loss_metric][-1]
-        # elif 'test' in loss_metric:
-        #     curr_k_metric_value = test_metrics[loss_metric][-1]
-        else:
-            raise ValueError("Invalid monitoring metric")
-
-        max_loss_idx = np.argmax(best_losses)
-        max_loss_value = best_losses[max_loss_idx]
-        max_loss_model = model_names[max_loss_idx]
-        if curr_k_metric_value < max_loss_value:
-            if max_loss_model is not None:
-                delete_checkpoint(max_loss_model)
-            #Set the savename to None here to save the model checkpoints
-            #   using the default filename format
-            model_name = save_model(model, 
-                                    optimizer, 
-                                    scheduler,
-                                    true_epoch, 
-                                    curr_k_metric_value, 
-                                    save_dir,
-                                    savename=None)
-            #Update loss value and model names
-            best_losses[max_loss_idx] = curr_k_metric_value
-            model_names[max_loss_idx] = model_name
-        #Save a restart model every epoch in case the training crashes
-        #   or needs to be restarted
-        save_model(model,
-                   optimizer,
-                   scheduler,
-                   true_epoch,
-                   curr_k_metric_value,
-                   save_dir,
-                   savename = f"{save_dir}/RESTART_checkpoint.pt")
-    writer.flush()
-    writer.close()
-
-    for i, tst_dloader in enumerate(test_dataloaders):
-        final_test_loss = test_loop(model,
-                                    tst_dloader,
-                                    loss_fn,
-                                    true_epoch,
-                                    writer,
-                                    write_freq,
-                                    write_tag = f" {i}")
-        test_metrics[f'test_loss_{i}'].append(final_test_loss)
+            if 'train' in loss_metric:
+                curr_k_metric_value = train_losses[train_names.index(loss_metric), epoch].item()
+            elif 'val' in loss_metric:
+                curr_k_metric_value = val_losses[val_names.index(loss_metric), epoch].item()
+            # elif 'test' in loss_metric:
+            #     curr_k_metric_value = test_losses[test_names.index(loss_metric), n_tests - 1].item()
+            else:
+                raise ValueError("Invalid monitoring metric")
+
+            #Only the main process manages checkpoints
+            if not is_main_process:
+                continue
+            #Failures of the previous epoch's checkpoint operations are raised before the heap is updated again
+            wait_for_checkpoints(pending_checkpoints)
+            heap_full = len(checkpoint_heap) >= top_checkpoints_n
+            #Non-finite losses are never kept since a NaN entry would break the ordering of the heap
+            if math.isfinite(curr_k_metric_value) and ((not heap_full) or (curr_k_metric_value < -checkpoint_heap[0][0])):
+                if heap_full:
+                    _, _, max_loss_model = heapq.heappop(checkpoint_heap)
+                    delete_checkpoint(max_loss_model, executor = executor, pending = pending_checkpoints)
+                #Set the savename to None here to save the model checkpoints
+                #   using the default filename format
+                model_name = save_model(model, 
+                                        optimizer, 
+                                        scheduler,
+                                        true_epoch, 
+                                        curr_k_metric_value, 
+                                        save_dir,
+                                        savename=None,
+                                        executor=executor,
+                                        pending=pending_checkpoints)
+                heapq.heappush(checkpoint_heap, (-curr_k_metric_value, checkpoint_counter, model_name))
+                checkpoint_counter += 1
+            #Save a restart model every epoch in case the training crashes
+            #   or needs to be restarted
+            save_model(model,
+                       optimizer,
+                       scheduler,
+                       true_epoch,
+                       curr_k_metric_value,
+                       save_dir,
+                       savename = f"{save_dir}/RESTART_checkpoint.pt",
+                       executor = executor,
+                       pending = pending_checkpoints)
+        if writer is not None:
+            writer.flush()
+            writer.close()
+        #Make sure all checkpoints are on disk, re-raising any failed background operation
+        wait_for_checkpoints(pending_checkpoints)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait = True)
+
+    #The final test is skipped if the last epoch already ran the periodic test on the same weights
+    if last_tested_epoch != true_epoch:
+        for i, tst_dloader in enumerate(test_dataloaders):
+            final_test_loss = test_loop(model,
+                                        tst_dloader,
+                                        loss_fn,
+                                        true_epoch,
+                                        writer,
+                                        write_freq,
+                                        write_tag = f" {i}")
+            test_losses[i, n_tests] = final_test_loss
+        n_tests += 1
     
-    if nepochs >= top_checkpoints_n:
-        assert(None not in model_names)
-        assert(all(best_losses < np.inf))
+    for m, precision in zip(precision_modules, original_precisions):
+        m.precision = precision
+    #Restore the uncompiled get_loss method
+    if 'get_loss' in vars(model):
+        del model.get_loss
+    if initialized_process_group:
+        dist.destroy_process_group()
+
+    train_metrics = {name : train_losses[i].tolist() for i, name in enumerate(train_names)}
+    val_metrics = {name : val_losses[i].tolist() for i, name in enumerate(val_names)}
+    test_metrics = {name : test_losses[i, :n_tests].tolist() for i, name in enumerate(test_names)}
+    model_names = [name for _, _, name in checkpoint_heap]
+    best_losses = np.array([-neg_loss for neg_loss, _, _ in checkpoint_heap])
+    if is_main_process and nepochs >= top_checkpoints_n:
+        assert(len(model_names) == top_checkpoints_n)
     return train_metrics, val_metrics, test_metrics, model_names, best_losses
\ No newline at end of file